@@ -0,0 +1,137 @@
+# approximate nearest-neighbour (IVF) index over the profile matrix, for very large enrollments
+import argparse
+import time
+
+import numpy as np
+
+
+def index_path(profiles_path: str) -> str:
+    return profiles_path + ".ann.npz"
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    return x / (np.linalg.norm(x, axis=-1, keepdims=True) + 1e-8)
+
+
+# argmax of x @ centroids.T, in row chunks so 100k+ profiles don't need one huge score matrix
+def _nearest(x: np.ndarray, centroids: np.ndarray, chunk: int = 16384) -> np.ndarray:
+    out = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk):
+        out[start:start + chunk] = np.argmax(x[start:start + chunk] @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex:
+    """Inverted-file index: profiles are clustered with spherical k-means and a query is
+    only scored against the rows in its n_probe closest clusters. n_probe is the
+    recall/latency knob (n_probe == n_lists is exact search).
+
+    `assign[i]` is the cluster of profile row i; `names` is the store's name list at
+    build time and is used to check the index still matches the profiles."""
+
+    def __init__(self, centroids: np.ndarray, assign: np.ndarray, names: list):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assign = np.asarray(assign, dtype=np.int64)
+        self.names = list(names)
+        self._lists = None
+
+    @property
+    def n_lists(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, names: list, n_lists: int = None, iters: int = 10,
+              seed: int = 0) -> "IVFIndex":
+        n = len(matrix)
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(n, n_lists, replace=False)].copy()
+        for _ in range(iters):
+            assign = _nearest(matrix, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, matrix)
+            empty = np.bincount(assign, minlength=n_lists) == 0
+            sums[empty] = matrix[rng.choice(n, int(empty.sum()))]
+            centroids = _normalize(sums).astype(np.float32)
+        return cls(centroids, _nearest(matrix, centroids), names)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        data = np.load(path, allow_pickle=False)
+        return cls(data['centroids'], data['assign'], list(data['names']))
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, assign=self.assign, names=np.array(self.names))
+
+    def _build_lists(self):
+        order = np.argsort(self.assign, kind='stable')
+        bounds = np.searchsorted(self.assign[order], np.arange(self.n_lists + 1))
+        self._lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.n_lists)]
+
+    # candidate rows for a normalized query
+    def candidates(self, query: np.ndarray, n_probe: int) -> np.ndarray:
+        if self._lists is None:
+            self._build_lists()
+        n_probe = min(max(1, n_probe), self.n_lists)
+        probe = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        return np.concatenate([self._lists[i] for i in probe])
+
+    # keep the index in step with ProfileStore.add / remove
+    def add_row(self, vec: np.ndarray, name: str):
+        self.assign = np.append(self.assign, int(np.argmax(self.centroids @ vec)))
+        self.names.append(name)
+        self._lists = None
+
+    def remove_row(self, i: int):
+        self.assign = np.delete(self.assign, i)
+        del self.names[i]
+        self._lists = None
+
+
+# how often the index's top-1 matches exact search for the given queries
+def verify(store, queries: np.ndarray, n_probe: int) -> dict:
+    queries = _normalize(np.asarray(queries, dtype=np.float32))
+    t0 = time.perf_counter()
+    exact = [store.search(q, 1)[0][0] for q in queries]
+    t_exact = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    approx = [store.search(q, 1, n_probe=n_probe)[0][0] for q in queries]
+    t_ann = time.perf_counter() - t0
+    agree = sum(a == b for a, b in zip(exact, approx))
+    return {
+        "queries": len(queries),
+        "n_probe": n_probe,
+        "n_lists": store.ann.n_lists,
+        "top1_agreement": agree / len(queries) if len(queries) else 1.0,
+        "exact_ms_per_query": 1000 * t_exact / max(1, len(queries)),
+        "ann_ms_per_query": 1000 * t_ann / max(1, len(queries)),
+    }
+
+
+# stand-in queries: profiles with noise added until they're about as close to their
+# speaker as a real held-out clip (cosine ~0.7)
+def noisy_queries(matrix: np.ndarray, n: int = 1000, noise: float = 0.06, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows = matrix[rng.choice(len(matrix), min(n, len(matrix)), replace=False)]
+    return rows + noise * rng.standard_normal(rows.shape).astype(np.float32)
+
+
+if __name__ == "__main__":
+    from profile_store import ProfileStore
+
+    parser = argparse.ArgumentParser(description="Build or check the ANN index next to a profiles file")
+    parser.add_argument("--profiles", default="speaker_profiles.pkl", help="Path to speaker profiles")
+    parser.add_argument("--build", action="store_true", help="(Re)build the index")
+    parser.add_argument("--n_lists", type=int, default=None, help="Number of clusters (default sqrt(N))")
+    parser.add_argument("--n_probe", type=int, default=8, help="Clusters searched per query")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of noisy profile queries for the check")
+    args = parser.parse_args()
+
+    store = ProfileStore.load(args.profiles)
+    if args.build or store.ann is None:
+        store.ann = IVFIndex.build(store.matrix, store.names, n_lists=args.n_lists)
+        store.ann.save(index_path(args.profiles))
+        print(f"Built index with {store.ann.n_lists} lists for {len(store)} profiles")
+    print(verify(store, noisy_queries(store.matrix, args.queries), args.n_probe))
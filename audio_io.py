@@ -0,0 +1,144 @@
+# audio decoding and resampling shared by training, testing, recognition and the api
+import functools
+import io
+import os
+import struct
+import threading
+
+import numpy as np
+import soundfile as sf
+import torch
+import torchaudio
+
+from shards import open_shards, parse_ref
+
+# plain PCM16 / float32 wav files at least this big are memory-mapped instead of read
+MMAP_MIN_BYTES = 8 * 1024 * 1024
+
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_FLOAT = 3
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+# (data offset, frames, channels, sample rate, numpy dtype) for an uncompressed PCM16 or
+# float32 wav, None for anything else (left to soundfile)
+def _wav_layout(header: bytes, file_size: int):
+    if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    pos, fmt = 12, None
+    while pos + 8 <= len(header):
+        chunk_id, size = header[pos:pos + 4], struct.unpack('<I', header[pos + 4:pos + 8])[0]
+        body = pos + 8
+        if chunk_id == b'fmt ' and size >= 16 and body + 16 <= len(header):
+            tag, channels, rate, _, _, bits = struct.unpack('<HHIIHH', header[body:body + 16])
+            if tag == _WAVE_FORMAT_EXTENSIBLE and size >= 40 and body + 26 <= len(header):
+                tag = struct.unpack('<H', header[body + 24:body + 26])[0]
+            fmt = (tag, channels, rate, bits)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            tag, channels, rate, bits = fmt
+            if (tag, bits) == (_WAVE_FORMAT_PCM, 16):
+                dtype = np.dtype('<i2')
+            elif (tag, bits) == (_WAVE_FORMAT_FLOAT, 32):
+                dtype = np.dtype('<f4')
+            else:
+                return None
+            size = min(size, file_size - body)
+            return body, size // (dtype.itemsize * channels), channels, rate, dtype
+        pos = body + size + (size & 1)
+    return None
+
+
+# (frames, channels) samples -> float32 (channels, frames) tensor; float32 mono data is
+# handed over without a copy
+def _to_tensor(samples: np.ndarray) -> torch.Tensor:
+    if samples.dtype == np.int16:
+        # one float32 copy, already (channels, frames), scaled in place
+        out = np.ascontiguousarray(samples.T, dtype=np.float32)
+        out *= 1 / 32768.0
+        return torch.from_numpy(out)
+    if not samples.flags.writeable:
+        # a view into immutable request bytes
+        samples = samples.copy()
+    return torch.from_numpy(samples.T if samples.shape[1] == 1 else np.ascontiguousarray(samples.T))
+
+
+def _read_mapped(source, max_duration: float = None):
+    if isinstance(source, (bytes, bytearray)):
+        header, file_size = bytes(source[:65536]), len(source)
+    else:
+        file_size = os.path.getsize(source)
+        if file_size < MMAP_MIN_BYTES:
+            return None
+        with open(source, 'rb') as f:
+            header = f.read(65536)
+    layout = _wav_layout(header, file_size)
+    if layout is None:
+        return None
+    offset, frames, channels, sr, dtype = layout
+    if max_duration is not None and max_duration > 0:
+        frames = min(frames, int(max_duration * sr))
+    if frames == 0:
+        return None
+    if isinstance(source, (bytes, bytearray)):
+        data = np.frombuffer(source, dtype=dtype, count=frames * channels, offset=offset)
+    else:
+        # copy-on-write so torch gets a writable array; pages are only read as they're touched
+        data = np.memmap(source, dtype=dtype, mode='c', offset=offset, shape=(frames * channels,))
+    return _to_tensor(data.reshape(frames, channels)), sr
+
+
+# decode a wav (path, packed clip or raw bytes) into a float32 (channels, samples) tensor, keeping only
+# the first max_duration seconds. Uncompressed PCM16/float32 wavs are mapped (big files) or
+# viewed in place (bytes); everything else goes through soundfile, decoding straight to float32
+def load_waveform(source, max_duration: float = None):
+    ref = parse_ref(source)
+    if ref is not None:
+        shards = open_shards(ref[0])
+        return shards.waveform(ref[1], max_duration), shards.sample_rate
+    mapped = _read_mapped(source, max_duration)
+    if mapped is not None:
+        return mapped
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with sf.SoundFile(source) as f:
+        sr, n_total = f.samplerate, len(f)
+        n_read = n_total if max_duration is None or max_duration <= 0 else min(int(max_duration * sr), n_total)
+        data = f.read(n_read, dtype='float32', always_2d=True)
+    return _to_tensor(data), sr
+
+
+# the bytes behind a path: the file's contents, or for a packed clip (see shards.py) the clip
+# as an in-memory wav; load_waveform decodes either
+def read_audio(source) -> bytes:
+    ref = parse_ref(source)
+    if ref is not None:
+        return open_shards(ref[0]).wav_bytes(ref[1])
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+# the resampling kernel is built once per rate pair and reused (the transform is stateless)
+@functools.lru_cache(maxsize=16)
+def _resampler(orig_freq: int, new_freq: int) -> torchaudio.transforms.Resample:
+    return torchaudio.transforms.Resample(orig_freq=orig_freq, new_freq=new_freq)
+
+
+def resample(waveform: torch.Tensor, orig_freq: int, new_freq: int) -> torch.Tensor:
+    if orig_freq == new_freq:
+        return waveform
+    with torch.no_grad():
+        return _resampler(orig_freq, new_freq)(waveform)
+
+
+_patch_lock = threading.Lock()
+_patched = False
+
+# wespeaker reads files with torchaudio.load; route that through load_waveform (once per process)
+def install_torchaudio_patch():
+    global _patched
+    with _patch_lock:
+        if not _patched:
+            torchaudio.load = lambda filepath, **kwargs: load_waveform(filepath)
+            _patched = True
@@ -0,0 +1,194 @@
+# cpu-optimized variants of the embedding network, built once and cached on disk as TorchScript
+import argparse
+import copy
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torchaudio.compliance.kaldi as kaldi
+
+from audio_io import resample
+
+BACKENDS = ("fp32", "jit", "int8")
+DEFAULT_MODEL_DIR = os.environ.get("ECHOAI_MODEL_DIR", os.path.join(os.path.expanduser("~"), ".cache", "echoai", "models"))
+
+
+# artifacts are only valid for the wespeaker + torch versions that produced them
+def artifact_path(language: str, backend: str, model_version: str, model_dir: str = DEFAULT_MODEL_DIR) -> str:
+    return os.path.join(model_dir, f"{language}-{backend}-{model_version}-torch{torch.__version__}.pt")
+
+
+def _example_feats(speaker, seconds: float) -> torch.Tensor:
+    noise = torch.randn(1, int(seconds * speaker.resample_rate)) * 0.01
+    return speaker.compute_fbank(noise, sample_rate=speaker.resample_rate, cmn=True).unsqueeze(0)
+
+
+def _output(outputs) -> torch.Tensor:
+    return outputs[-1] if isinstance(outputs, tuple) else outputs
+
+
+# trace + freeze the network (freezing folds batch norm into the convolutions); "int8"
+# first swaps the Linear layers for dynamically quantized int8 ones. The traced graph is
+# checked on a second clip length so a shape that got baked in during tracing fails here
+# rather than on a real request.
+def optimize(speaker, backend: str) -> torch.jit.ScriptModule:
+    if backend not in BACKENDS or backend == "fp32":
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS[1:]}")
+    net = copy.deepcopy(speaker.model).cpu().eval()
+    if backend == "int8":
+        net = torch.ao.quantization.quantize_dynamic(net, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(net, _example_feats(speaker, 2.0), check_trace=False).eval())
+        check = _example_feats(speaker, 3.3)
+        expected, got = _output(net(check)), _output(traced(check))
+    if expected.shape != got.shape or not torch.allclose(expected, got, atol=1e-3, rtol=1e-3):
+        raise RuntimeError(f"Traced {backend} model does not generalize across clip lengths")
+    return traced
+
+
+def _save(net: torch.jit.ScriptModule, path: str, meta: dict = None):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    try:
+        torch.jit.save(net, tmp, _extra_files={"echoai.json": json.dumps(meta)} if meta else None)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# a copy of the wespeaker Speaker whose .model is the optimized network, built on the
+# first call and loaded from model_dir afterwards
+def load_backend(speaker, language: str, backend: str, model_version: str, model_dir: str = DEFAULT_MODEL_DIR):
+    if backend == "fp32":
+        return speaker
+    path = artifact_path(language, backend, model_version, model_dir)
+    if os.path.isfile(path):
+        net = torch.jit.load(path, map_location="cpu")
+    else:
+        net = optimize(speaker, backend)
+        _save(net, path)
+    optimized = copy.copy(speaker)
+    optimized.model = net
+    optimized.device = torch.device("cpu")
+    return optimized
+
+
+# self-contained model artifact stored next to the profiles: the traced network plus the
+# front-end settings, so a server can load it without importing wespeaker or resolving a checkpoint
+def exported_path(profiles_path: str) -> str:
+    return profiles_path + ".model.pt"
+
+
+def export(speaker, path: str, language: str, backend: str = "jit", model_version: str = "unknown") -> dict:
+    meta = {
+        "language": language,
+        "backend": backend,
+        "model_version": model_version,
+        "torch": torch.__version__,
+        "resample_rate": speaker.resample_rate,
+        "num_mel_bins": int(_example_feats(speaker, 1.0).shape[-1]),
+    }
+    _save(optimize(speaker, backend), path, meta)
+    return meta
+
+
+class ExportedSpeaker:
+    """The parts of wespeaker's Speaker that we use, backed by an exported artifact.
+
+    compute_fbank / extract_embedding_from_pcm do exactly what wespeaker's do (kaldi
+    fbank, 25/10 ms hamming frames, per-utterance mean normalization), so embeddings
+    match the model the artifact was exported from."""
+
+    def __init__(self, path: str):
+        extra = {"echoai.json": ""}
+        self.model = torch.jit.load(path, map_location="cpu", _extra_files=extra)
+        self.meta = json.loads(extra["echoai.json"])
+        self.language = self.meta["language"]
+        self.resample_rate = self.meta["resample_rate"]
+        self.num_mel_bins = self.meta["num_mel_bins"]
+        self.device = torch.device("cpu")
+
+    def compute_fbank(self, wavform: torch.Tensor, sample_rate: int = 16000, cmn: bool = True) -> torch.Tensor:
+        feat = kaldi.fbank(wavform, num_mel_bins=self.num_mel_bins, frame_length=25, frame_shift=10,
+                           sample_frequency=sample_rate, window_type='hamming')
+        if cmn:
+            feat = feat - torch.mean(feat, 0)
+        return feat
+
+    def extract_embedding_from_pcm(self, pcm: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        pcm = resample(pcm.to(torch.float), sample_rate, self.resample_rate)
+        feats = self.compute_fbank(pcm, sample_rate=self.resample_rate, cmn=True).unsqueeze(0)
+        with torch.no_grad():
+            return _output(self.model(feats))[0]
+
+
+# embeds the profile file's held-out test split with fp32 and with `backend`; reports how
+# far the embeddings moved (cosine to the fp32 embedding), the change in top-1 accuracy
+# against the stored profiles and the per-clip embedding time of each
+def compare(profiles_path: str, backend: str, language: str = "english", max_duration: float = None) -> dict:
+    from profile_store import ProfileStore
+    from recognize_speaker import load_model, load_speech
+
+    store = ProfileStore.load(profiles_path)
+    test_data = {k: v for k, v in store.meta.get('test_data', {}).items() if k in store.index}
+    models = {"fp32": load_model(language), backend: load_model(language, backend)}
+    cosines = []
+    correct = {name: 0 for name in models}
+    seconds = {name: 0.0 for name in models}
+    for true_speaker, paths in test_data.items():
+        for path in paths:
+            waveform, sr, _ = load_speech(path, max_duration)
+            embs = {}
+            for name, model in models.items():
+                t0 = time.perf_counter()
+                embs[name] = np.asarray(model.extract_embedding_from_pcm(waveform, sr)).flatten()
+                seconds[name] += time.perf_counter() - t0
+                correct[name] += store.search(embs[name], 1)[0][0] == true_speaker
+            a, b = embs["fp32"], embs[backend]
+            cosines.append(float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-8)))
+    n = len(cosines)
+    if not n:
+        raise ValueError(f"No test data in {profiles_path}")
+    return {
+        "backend": backend,
+        "files": n,
+        "mean_cosine": float(np.mean(cosines)),
+        "min_cosine": float(np.min(cosines)),
+        "fp32_accuracy": correct["fp32"] / n,
+        "backend_accuracy": correct[backend] / n,
+        "accuracy_delta": (correct[backend] - correct["fp32"]) / n,
+        "fp32_ms_per_clip": 1000 * seconds["fp32"] / n,
+        "backend_ms_per_clip": 1000 * seconds[backend] / n,
+        "speedup": seconds["fp32"] / seconds[backend] if seconds[backend] else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an optimized backend and check it against fp32")
+    parser.add_argument("--profiles", default="speaker_profiles.pkl", help="Profiles whose test split is used for the check")
+    parser.add_argument("--backend", default=None, choices=BACKENDS[1:], help="Default: int8 for the check, jit for --export")
+    parser.add_argument("--language", default="english", choices=["english", "chinese"])
+    parser.add_argument("--max_duration", type=float, default=30, help="Use first N sec of each file (default 30, 0=full)")
+    parser.add_argument("--export", action="store_true", help="Write the model artifact next to --profiles instead (build step)")
+    args = parser.parse_args()
+
+    if args.export:
+        from recognize_speaker import load_model, model_version
+
+        path = exported_path(args.profiles)
+        meta = export(load_model(args.language), path, args.language, args.backend or "jit", model_version())
+        print(f"Exported {meta['backend']} {meta['language']} model to {path}")
+        raise SystemExit
+    args.backend = args.backend or "int8"
+    result = compare(args.profiles, args.backend, args.language, None if args.max_duration == 0 else args.max_duration)
+    print(f"{result['files']} test files, {args.backend} vs fp32:")
+    print(f"  embedding cosine: mean {result['mean_cosine']:.5f}, min {result['min_cosine']:.5f}")
+    print(f"  accuracy: fp32 {result['fp32_accuracy']:.2%}, {args.backend} {result['backend_accuracy']:.2%} "
+          f"({result['accuracy_delta']:+.2%})")
+    print(f"  ms per clip: fp32 {result['fp32_ms_per_clip']:.1f}, {args.backend} {result['backend_ms_per_clip']:.1f}")
@@ -0,0 +1,284 @@
+# performance benchmarks: recognize() latency, /identify throughput and training speed
+# python benchmark.py --output bench.json   (compare the json between commits)
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+import numpy as np
+import soundfile as sf
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# speech-ish test signal: a few harmonics with a wobbling pitch, syllable-rate amplitude
+# envelope and some noise; `voice` shifts the pitch so synthetic speakers differ
+def synth_wav(path: str, seconds: float, sample_rate: int = 16000, voice: int = 0, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    f0 = 110 + 35 * voice + 10 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    x = sum(np.sin(k * phase) / k for k in range(1, 6))
+    x *= 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t) ** 2
+    x = 0.2 * x / np.max(np.abs(x)) + 0.01 * rng.standard_normal(len(t))
+    sf.write(path, x.astype(np.float32), sample_rate, subtype='PCM_16')
+    return path
+
+
+def percentiles(samples: list) -> dict:
+    arr = np.asarray(samples) * 1000
+    return {
+        "n": len(arr),
+        "mean_ms": float(arr.mean()),
+        "p50_ms": float(np.percentile(arr, 50)),
+        "p99_ms": float(np.percentile(arr, 99)),
+        "min_ms": float(arr.min()),
+    }
+
+
+def make_corpus(root: str, speakers: int, files_per_speaker: int, seconds: float) -> str:
+    data_dir = os.path.join(root, "speakers")
+    for s in range(speakers):
+        os.makedirs(os.path.join(data_dir, f"voice{s}"), exist_ok=True)
+        for i in range(files_per_speaker):
+            synth_wav(os.path.join(data_dir, f"voice{s}", f"{i}.wav"), seconds, voice=s, seed=100 * s + i)
+    return data_dir
+
+
+def bench_train(data_dir: str, profiles_path: str, workers: int, max_duration: float) -> dict:
+    from train_speaker_model import load_labeled_data, train
+
+    n_files = sum(len(v) for v in load_labeled_data(data_dir).values())
+    t0 = time.perf_counter()
+    train(data_dir, profiles_path, language="english", max_duration=max_duration, workers=workers)
+    elapsed = time.perf_counter() - t0
+    return {"files": n_files, "workers": workers, "seconds": elapsed, "files_per_sec": n_files / elapsed}
+
+
+# first call in a fresh interpreter: imports + model load + one embedding
+def bench_cold(profiles_path: str, wav_path: str) -> dict:
+    code = (
+        "import time; t0 = time.perf_counter()\n"
+        "from recognize_speaker import recognize\n"
+        "t1 = time.perf_counter()\n"
+        f"recognize({profiles_path!r}, {wav_path!r}, max_duration=30)\n"
+        "t2 = time.perf_counter()\n"
+        "print(t1 - t0, t2 - t1)\n"
+    )
+    out = subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True)
+    import_s, first_call_s = map(float, out.stdout.strip().splitlines()[-1].split())
+    return {"import_s": import_s, "first_call_s": first_call_s, "total_s": import_s + first_call_s}
+
+
+# API cold start in a fresh process: import main, first /health answer, model ready; with
+# exported=True the model artifact is written next to the profiles first (the render build step)
+def bench_startup(profiles_path: str, exported: bool = False) -> dict:
+    from backends import export, exported_path
+    from main import STARTUP_BUDGET_S
+    from recognize_speaker import load_model, model_version
+
+    artifact = exported_path(profiles_path)
+    if exported:
+        export(load_model("english"), artifact, "english", "jit", model_version())
+    code = (
+        "import time; t0 = time.perf_counter()\n"
+        "import main\n"
+        "t1 = time.perf_counter()\n"
+        f"main.PROFILES_PATH = {profiles_path!r}\n"
+        "from fastapi.testclient import TestClient\n"
+        "with TestClient(main.app) as c:\n"
+        "    c.get('/health'); t2 = time.perf_counter()\n"
+        "    while c.get('/health').status_code != 200 and main.load_error is None:\n"
+        "        time.sleep(0.05)\n"
+        "    t3 = time.perf_counter()\n"
+        "print(t1 - t0, t2 - t0, t3 - t0)\n"
+    )
+    try:
+        out = subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True)
+    finally:
+        if exported and os.path.exists(artifact):
+            os.remove(artifact)
+    import_s, health_s, ready_s = map(float, out.stdout.strip().splitlines()[-1].split())
+    return {"import_s": import_s, "first_health_s": health_s, "ready_s": ready_s,
+            "budget_s": STARTUP_BUDGET_S, "within_budget": ready_s <= STARTUP_BUDGET_S}
+
+
+# memory of an api with N worker processes: `uvicorn --workers N` (every worker loads its own
+# model and profiles) against serve.py (loaded once, then forked). rss counts shared pages in
+# every process that maps them, pss splits them, so the pss sum is the real footprint
+def bench_workers(profiles_path: str, workers: int) -> dict:
+    from serve import tree_memory
+
+    root = tempfile.mkdtemp(prefix="echoai-serve-")
+    shutil.copy(profiles_path, os.path.join(root, "speaker_profiles.pkl"))
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = str(s.getsockname()[1])
+    env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+    commands = {
+        "uvicorn": [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", HERE, "--host", "127.0.0.1",
+                    "--port", port, "--workers", str(workers)],
+        "serve": [sys.executable, os.path.join(HERE, "serve.py"), "--host", "127.0.0.1", "--port", port,
+                  "--workers", str(workers), "--shared_dir", os.path.join(root, "shared")],
+    }
+    results = {"workers": workers}
+    try:
+        for name, cmd in commands.items():
+            proc = subprocess.Popen(cmd, cwd=root, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            try:
+                # every worker prints "Ready in ..." once its model is loaded
+                ready = 0
+                for line in proc.stdout:
+                    ready += line.startswith("Ready in")
+                    if ready == workers:
+                        break
+                if ready < workers:
+                    raise RuntimeError(f"{name}: only {ready} of {workers} workers became ready")
+                time.sleep(1)
+                results[name] = tree_memory(proc.pid)
+            finally:
+                proc.terminate()
+                proc.wait(timeout=60)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    results["pss_saved_mb"] = round(results["uvicorn"]["pss_mb"] - results["serve"]["pss_mb"], 1)
+    return results
+
+
+def bench_warm(profiles_path: str, wavs: dict, repeat: int) -> dict:
+    from recognize_speaker import recognize
+
+    results = {}
+    for label, path in wavs.items():
+        recognize(profiles_path, path, max_duration=30)
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            recognize(profiles_path, path, max_duration=30)
+            times.append(time.perf_counter() - t0)
+        results[label] = percentiles(times)
+    return results
+
+
+# /identify under load with the result cache off (every request runs the model), plus the
+# latency of repeats answered from the cache
+def bench_api(profiles_path: str, wav_path: str, requests: int, concurrency: int) -> dict:
+    from fastapi.testclient import TestClient
+    import main
+    from result_cache import ResultCache
+
+    main.PROFILES_PATH = profiles_path
+    main.results = ResultCache(0)
+    with open(wav_path, 'rb') as f:
+        audio = f.read()
+    with TestClient(main.app) as client:
+        deadline = time.time() + 300
+        while client.get("/health").status_code != 200:
+            if time.time() > deadline:
+                raise RuntimeError("API did not become ready")
+            time.sleep(0.1)
+
+        def one(_):
+            t0 = time.perf_counter()
+            r = client.post("/identify", files={"file": ("bench.wav", audio, "audio/wav")})
+            return time.perf_counter() - t0, r.status_code
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as ex:
+            results = list(ex.map(one, range(requests)))
+        wall = time.perf_counter() - t0
+
+        main.results = ResultCache(16)
+        one(None)
+        hits = [one(None) for _ in range(min(requests, 50))]
+
+    ok = [lat for lat, status in results if status == 200]
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "ok": len(ok),
+        "rejected": sum(1 for _, status in results if status == 503),
+        "requests_per_sec": len(ok) / wall,
+        "latency": percentiles(ok) if ok else None,
+        "cache_hit_latency": percentiles([lat for lat, status in hits if status == 200]),
+    }
+
+
+def environment() -> dict:
+    env = {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()}
+    try:
+        env["commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                                       capture_output=True, text=True).stdout.strip()
+    except OSError:
+        pass
+    try:
+        import torch
+        env["torch"] = torch.__version__
+        env["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return env
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark recognition latency, API throughput and training speed")
+    parser.add_argument("--output", default=None, help="Write the JSON results here (default: stdout)")
+    parser.add_argument("--durations", type=float, nargs="+", default=[1, 5, 15, 30, 60], help="Clip lengths in seconds")
+    parser.add_argument("--sample_rates", type=int, nargs="+", default=[8000, 16000, 44100], help="Clip sample rates")
+    parser.add_argument("--repeat", type=int, default=5, help="Warm recognize() calls per clip")
+    parser.add_argument("--speakers", type=int, default=4, help="Synthetic speakers to train")
+    parser.add_argument("--files_per_speaker", type=int, default=3, help="Training files per synthetic speaker")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="Training worker counts to time")
+    parser.add_argument("--requests", type=int, default=100, help="/identify requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent /identify clients")
+    parser.add_argument("--skip_cold", action="store_true", help="Skip the fresh-process cold start runs")
+    parser.add_argument("--skip_api", action="store_true", help="Skip the /identify load test")
+    parser.add_argument("--serve_workers", type=int, default=4, help="Worker count for the serve.py memory comparison (0=skip)")
+    args = parser.parse_args()
+
+    # synthetic data only, no embedding cache (so every run really hits the model), and
+    # progress output goes to stderr so stdout is just the json
+    root = tempfile.mkdtemp(prefix="echoai-bench-")
+    try:
+        with redirect_stdout(sys.stderr):
+            results = {"environment": environment()}
+            data_dir = make_corpus(root, args.speakers, args.files_per_speaker, seconds=10)
+            profiles_path = os.path.join(root, "profiles.pkl")
+
+            results["train"] = [bench_train(data_dir, profiles_path, w, max_duration=30) for w in args.workers]
+
+            wavs = {}
+            for sr in args.sample_rates:
+                for d in args.durations:
+                    wavs[f"{d:g}s@{sr}Hz"] = synth_wav(os.path.join(root, f"clip_{d:g}_{sr}.wav"), d, sr, voice=1)
+            probe = wavs.get("5s@16000Hz") or next(iter(wavs.values()))
+
+            if not args.skip_cold:
+                results["recognize_cold"] = bench_cold(profiles_path, probe)
+                results["api_startup"] = {
+                    "wespeaker": bench_startup(profiles_path),
+                    "exported": bench_startup(profiles_path, exported=True),
+                }
+            results["recognize_warm"] = bench_warm(profiles_path, wavs, args.repeat)
+            if not args.skip_api:
+                results["api"] = bench_api(profiles_path, probe, args.requests, args.concurrency)
+            if args.serve_workers:
+                results["serve_memory"] = bench_workers(profiles_path, args.serve_workers)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+        print(f"Wrote {args.output}")
+    else:
+        print(text)
@@ -0,0 +1,87 @@
+# on-disk embedding cache shared by training, testing and recognition
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.environ.get("ECHOAI_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "echoai", "embeddings"))
+DEFAULT_MAX_MB = 512
+
+
+class EmbeddingCache:
+    """Embeddings stored as one .npy file per key under cache_dir.
+
+    Keys hash the raw audio bytes together with everything else that changes the
+    embedding (model language/version, max_duration, ...). A file's mtime is its
+    last-used time, and the least recently used files are evicted once the cache
+    grows past max_mb."""
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_mb: float = DEFAULT_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(audio_bytes: bytes, **settings) -> str:
+        h = hashlib.sha256(audio_bytes)
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            emb = np.load(path)
+            os.utime(path)
+            return emb
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def put(self, key: str, emb: np.ndarray):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file and rename so concurrent readers never see half a file
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(emb, dtype=np.float32))
+        os.replace(tmp, path)
+        if self._size is None:
+            self._size = self._scan_size()
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".npy"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield st.st_mtime, st.st_size, path
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    # drop least recently used entries until the cache is back under 90% of the cap
+    def evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self._size = total
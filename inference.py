@@ -0,0 +1,144 @@
+# scheduling helpers for running the embedding model under concurrent load
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MicroBatcher:
+    """Gathers fbank feature matrices submitted from many request threads and runs them
+    through the model together. A batch is closed when it reaches max_batch_size or when
+    max_wait_ms has passed since its first item arrived.
+
+    Clips are grouped by length before the forward pass. With bucket_frames > 1 clips whose
+    lengths round down to the same multiple of bucket_frames share a batch, and only then are
+    they cropped, to the shortest clip in the group (dropping < bucket_frames frames from the
+    tail, and nothing from the shortest). A clip with no other length in its bucket is run
+    whole, so it gets the same embedding as unbatched inference; bucket_frames=1 only batches
+    exact matches.
+
+    Each resolved future also carries `forward_seconds` (the forward pass it was part of)
+    and `batch_size`, so callers can tell time spent waiting from time spent in the model."""
+
+    def __init__(self, forward, max_batch_size: int = 8, max_wait_ms: float = 5.0, bucket_frames: int = 50):
+        self.forward = forward
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.bucket_frames = max(1, bucket_frames)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # feats: (frames, mel bins) tensor; resolves to that clip's embedding
+    def submit(self, feats) -> Future:
+        fut = Future()
+        self._queue.put((feats, fut))
+        return fut
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _bucket(self, n: int) -> int:
+        if n < self.bucket_frames:
+            return n
+        return n - n % self.bucket_frames
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            groups = {}
+            for feats, fut in batch:
+                if fut.set_running_or_notify_cancel():
+                    groups.setdefault(self._bucket(feats.shape[0]), []).append((feats, fut))
+            for items in groups.values():
+                # crop only when the bucket actually mixes lengths, and only down to its shortest clip
+                frames = min(f.shape[0] for f, _ in items)
+                if any(f.shape[0] != frames for f, _ in items):
+                    items = [(f[:frames], fut) for f, fut in items]
+                try:
+                    t0 = time.perf_counter()
+                    embs = self.forward([f for f, _ in items])
+                    elapsed = time.perf_counter() - t0
+                    for (_, fut), emb in zip(items, embs):
+                        fut.forward_seconds = elapsed
+                        fut.batch_size = len(items)
+                        fut.set_result(emb)
+                except Exception as e:
+                    for _, fut in items:
+                        fut.set_exception(e)
+
+
+class BoundedPool:
+    """Thread pool that refuses new work once `workers` jobs are running and `max_queue`
+    more are waiting, so callers can fail fast instead of piling up behind the model."""
+
+    def __init__(self, workers: int = 8, max_queue: int = 32):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="echoai-infer")
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    # jobs waiting for a free worker
+    @property
+    def depth(self) -> int:
+        return max(0, self._pending - self.workers)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "active": min(self._pending, self.workers),
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+        }
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                raise QueueFull(f"{self._pending} jobs pending")
+            self._pending += 1
+        try:
+            fut = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._done(None)
+            raise
+        fut.add_done_callback(self._done)
+        return fut
+
+    def _done(self, _):
+        with self._lock:
+            self._pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
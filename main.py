@@ -1,43 +1,377 @@
 # api
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse
-import shutil
+# torch / wespeaker are only imported by the background loader, so the server starts
+# listening (and /health answers) right away
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, Request, Response, UploadFile, File, Form, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+import asyncio
 import os
-from recognize_speaker import recognize
+import threading
+import time
+import metrics
+from inference import BoundedPool, QueueFull
+from metrics import REQUESTS, StageTimer
+from profile_sets import DEFAULT_SET, ProfileSets, UnknownProfileSet
+from profile_store import NoSpeakersEnrolled
+from result_cache import ResultCache, audio_digest
+
+STARTED = time.monotonic()
 
-app = FastAPI(title="EchoAI", description="Speaker recognition — upload a .wav to identify who's speaking")
-UPLOAD_DIR = "temp_uploads"
 PROFILES_PATH = "speaker_profiles.pkl"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+# other sites' speaker groups: ?profile_set=<id> uses <dir>/<id>.pkl; resident sets are kept
+# under a memory budget and reloaded when their file changes
+PROFILE_SETS_DIR = os.environ.get("ECHOAI_PROFILE_SETS_DIR", "profile_sets")
+PROFILE_SETS_MB = float(os.environ.get("ECHOAI_PROFILE_SETS_MB", "1024"))
+LANGUAGE = "english"
+MAX_DURATION = 30
+# micro-batching of concurrent requests (ECHOAI_MAX_BATCH=1 turns it off)
+MAX_BATCH = int(os.environ.get("ECHOAI_MAX_BATCH", "8"))
+MAX_WAIT_MS = float(os.environ.get("ECHOAI_MAX_WAIT_MS", "5"))
+BUCKET_FRAMES = int(os.environ.get("ECHOAI_BUCKET_FRAMES", "50"))
+# inference runs off the event loop in a bounded pool; when it's full we answer 503 right away
+WORKERS = int(os.environ.get("ECHOAI_WORKERS", str(max(MAX_BATCH, 1))))
+MAX_QUEUE = int(os.environ.get("ECHOAI_MAX_QUEUE", "32"))
+RETRY_AFTER = int(os.environ.get("ECHOAI_RETRY_AFTER", "1"))
+# speech selection before embedding; per request with ?vad=true/false
+VAD_DEFAULT = os.environ.get("ECHOAI_VAD", "0") == "1"
+# early-exit recognition: ECHOAI_CASCADE=3,10 scores a 3 s then a 10 s prefix before the whole
+# clip and stops once the top speaker leads by ECHOAI_CASCADE_MARGIN; per request with ?cascade=
+CASCADE_STAGES = tuple(float(s) for s in os.environ.get("ECHOAI_CASCADE", "").split(",") if s.strip())
+CASCADE_MARGIN = float(os.environ.get("ECHOAI_CASCADE_MARGIN", "0.1"))
+CASCADE_DEFAULT = bool(CASCADE_STAGES)
+VAD_THRESHOLD_DB = float(os.environ.get("ECHOAI_VAD_THRESHOLD_DB", "-35"))
+# clusters searched in the ANN index when one was built next to the profiles (0 = exact search)
+ANN_PROBE = int(os.environ.get("ECHOAI_ANN_PROBE", "0"))
+# embedding model variant: fp32 (default), jit or int8 (see backends.py)
+BACKEND = os.environ.get("ECHOAI_BACKEND", "fp32")
+# model artifact from `python backends.py --export` (default: next to the profiles); used instead of
+# wespeaker when present
+MODEL_PATH = os.environ.get("ECHOAI_MODEL_PATH")
+# /identify answers for repeated uploads of the same clip, per profile version (0 entries = off)
+RESULT_CACHE_SIZE = int(os.environ.get("ECHOAI_RESULT_CACHE", "1024"))
+RESULT_CACHE_TTL = float(os.environ.get("ECHOAI_RESULT_CACHE_TTL", "300"))
+# seconds from import to ready before a warning is logged
+STARTUP_BUDGET_S = float(os.environ.get("ECHOAI_STARTUP_BUDGET_S", "30"))
+
+# profile matrices are mapped from files here so worker processes share them (set by serve.py)
+SHARED_DIR = os.environ.get("ECHOAI_SHARED_DIR")
+
+# resident recognizer, built once in the background at startup
+recognizer = None
+profile_sets = None
+load_error = None
+pool = None
+VAD = None
+startup = None
+results = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+# (recognizer, profile sets, import seconds, model seconds) built by preload() before serve.py forks
+_preloaded = None
+
+
+# model + profiles, without starting any threads, so it can also run before a fork
+def _build_recognizer():
+    global VAD
+    if not os.path.isfile(PROFILES_PATH):
+        raise FileNotFoundError("Speaker profiles not loaded. Add speaker_profiles.pkl to the repo or run training.")
+    t0 = time.monotonic()
+    from backends import exported_path
+    from recognize_speaker import Recognizer
+    from vad import EnergyVad
+    imports_s = time.monotonic() - t0
+    VAD = EnergyVad(threshold_db=VAD_THRESHOLD_DB)
+    model_path = MODEL_PATH or exported_path(PROFILES_PATH)
+    rec = Recognizer(PROFILES_PATH, language=LANGUAGE, n_probe=ANN_PROBE or None, backend=BACKEND,
+                     model_path=model_path if os.path.isfile(model_path) else None)
+    rec.warmup()
+    sets = ProfileSets(PROFILES_PATH, PROFILE_SETS_DIR, PROFILE_SETS_MB, SHARED_DIR)
+    sets.adopt(rec.profiles)
+    return rec, sets, imports_s, time.monotonic() - t0 - imports_s
+
+
+# load everything in this process so forked workers inherit the model copy-on-write
+def preload():
+    global _preloaded
+    _preloaded = _build_recognizer()
+
+
+def _load_recognizer():
+    global recognizer, profile_sets, load_error, startup
+    try:
+        rec, sets, imports_s, model_s = _preloaded or _build_recognizer()
+        rec.enable_batching(MAX_BATCH, MAX_WAIT_MS, BUCKET_FRAMES)
+        profile_sets = sets
+        t2 = time.monotonic()
+        startup = {"imports_s": round(imports_s, 3), "model_s": round(model_s, 3),
+                   "ready_s": round(t2 - STARTED, 3), "exported_model": rec.model_path is not None,
+                   "preloaded": _preloaded is not None}
+        print(f"Ready in {startup['ready_s']:.1f}s (imports {startup['imports_s']:.1f}s, model {startup['model_s']:.1f}s"
+              f"{', exported artifact' if rec.model_path else ''}{', preloaded' if _preloaded else ''})")
+        if startup["ready_s"] > STARTUP_BUDGET_S:
+            print(f"Warning: startup took {startup['ready_s']:.1f}s, over the {STARTUP_BUDGET_S:g}s budget"
+                  f"{'' if rec.model_path else '; run python backends.py --export at build time'}")
+        recognizer = rec
+    except Exception as e:
+        load_error = str(e)
+        print(f"Failed to load recognizer: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool
+    pool = BoundedPool(WORKERS, MAX_QUEUE)
+    threading.Thread(target=_load_recognizer, daemon=True).start()
+    yield
+    pool.shutdown()
+    if recognizer is not None and recognizer.batcher is not None:
+        recognizer.batcher.close()
+
+
+app = FastAPI(title="EchoAI", description="Speaker recognition — upload a .wav to identify who's speaking", lifespan=lifespan)
+
+metrics.Gauge("echoai_queue_depth", "Inference jobs waiting for a free worker", lambda: pool.depth)
+metrics.Gauge("echoai_jobs_pending", "Inference jobs running or waiting", lambda: pool.pending)
+metrics.Gauge("echoai_speakers", "Speakers enrolled in the default profile set", lambda: len(profile_sets.get()))
+metrics.Gauge("echoai_profile_sets_resident", "Profile sets held in memory", lambda: len(profile_sets.stats()["resident"]))
+metrics.Gauge("echoai_profile_sets_bytes", "Memory used by resident profile sets", lambda: profile_sets.resident_bytes)
+metrics.Gauge("echoai_startup_seconds", "Seconds from import until the model was ready", lambda: startup["ready_s"])
+
+
+# per-route request counts; labelled by the route template so /enroll/{name} stays one series
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUESTS.inc(endpoint=getattr(route, "path", "other"), status=response.status_code)
+    return response
+
+
+# prometheus scrape target: per-stage latency histograms, audio seconds, queue depth, peak RSS
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "app": "EchoAI"}
+    if recognizer is not None and recognizer.ready:
+        return {"status": "ok", "app": "EchoAI", "ready": True, "queue": pool.stats(), "startup": startup,
+                "cascade": recognizer.cascade_report.stats(),
+                "profile_sets": profile_sets.stats()}
+    status = "error" if load_error else "loading"
+    return JSONResponse({"status": status, "app": "EchoAI", "ready": False, "detail": load_error,
+                         "queue": pool.stats()}, status_code=503)
+
+
+def _decode(audio_bytes: bytes, vad: bool, timer: StageTimer = None):
+    from recognize_speaker import load_speech
+
+    try:
+        waveform, sr, stats = load_speech(audio_bytes, MAX_DURATION, VAD if vad else None, timer)
+    except Exception:
+        raise ValueError("Could not read the audio, please upload a valid .wav file")
+    if waveform.shape[-1] == 0:
+        raise ValueError("Audio file is empty")
+    return waveform, sr, stats
+
 
+# runs in a pool worker: decode + embed + score
+def _identify_job(audio_bytes: bytes, top_k: Optional[int], vad: bool, timer: StageTimer, queued_at: float,
+                  profile_set: Optional[str] = None, cascade: bool = False):
+    timer.add("queue_wait", time.perf_counter() - queued_at)
+    store = profile_sets.get(profile_set)
+    waveform, sr, stats = _decode(audio_bytes, vad, timer)
+    if cascade:
+        name, confidence, scores, info = recognizer.identify_cascade(
+            waveform, sr, CASCADE_STAGES or None, CASCADE_MARGIN, top_k=top_k, timer=timer, store=store)
+        return name, confidence, scores, stats, info
+    return (*recognizer.identify(waveform, sr, top_k=top_k, timer=timer, store=store), stats, None)
+
+
+# runs in a pool worker: embed every clip and fold them into one speaker's profile
+# (enrolling into a profile set that doesn't exist yet creates it)
+def _enroll_job(name: str, clips: list, vad: bool, profile_set: Optional[str] = None):
+    embeddings = []
+    for audio_bytes in clips:
+        waveform, sr, _ = _decode(audio_bytes, vad)
+        embeddings.append(recognizer.embed(waveform, sr, batch=False))
+    store = profile_sets.update(profile_set, lambda s: s.add(name, sum(embeddings), len(embeddings)), create=True)
+    return len(embeddings), len(store)
+
+
+def _unenroll(name: str, profile_set: Optional[str] = None):
+    def change(store):
+        if name not in store.index:
+            raise KeyError(name)
+        store.remove(name)
+    return profile_sets.update(profile_set, change)
+
+
+async def _run_in_pool(fn, *args):
+    if recognizer is None or not recognizer.ready:
+        raise HTTPException(503, load_error or "Model is still loading, try again shortly.")
+    try:
+        job = pool.submit(fn, *args)
+    except QueueFull:
+        raise HTTPException(503, "Server is busy, try again shortly.", headers={"Retry-After": str(RETRY_AFTER)})
+    try:
+        return await asyncio.wrap_future(job)
+    except UnknownProfileSet as e:
+        raise HTTPException(404, f"Unknown profile set {e.args[0]}")
+    except NoSpeakersEnrolled as e:
+        # nothing wrong with the request, the set is just empty (e.g. everyone was deleted)
+        raise HTTPException(409, str(e))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+# ?timings=true adds the per-stage breakdown (ms) of this request to the response
 @app.post("/identify")
-async def identify_speaker(file: UploadFile = File(...)):
+async def identify_speaker(response: Response, file: UploadFile = File(...), top_k: Optional[int] = Query(None, ge=1),
+                           vad: bool = VAD_DEFAULT, timings: bool = False, profile_set: Optional[str] = None,
+                           cascade: bool = CASCADE_DEFAULT):
     if not file.filename or not file.filename.lower().endswith(".wav"):
         raise HTTPException(400, "Please upload a .wav file")
-    if not os.path.isfile(PROFILES_PATH):
-        raise HTTPException(503, "Speaker profiles not loaded. Add speaker_profiles.pkl to the repo or run training.")
+    if recognizer is None or not recognizer.ready:
+        raise HTTPException(503, load_error or "Model is still loading, try again shortly.")
+
+    # decode the upload in memory; nothing is written to disk
+    timer = StageTimer()
+    t0 = time.perf_counter()
+    with timer.stage("upload_read"):
+        audio_bytes = await file.read()
+    # the same bytes against the same version of the profiles get the same answer, so repeats
+    # are served from the cache and concurrent repeats share one job (X-Cache: hit/coalesced/miss)
+    with timer.stage("hash"):
+        digest = audio_digest(audio_bytes)
+    set_id = profile_set or DEFAULT_SET
+    try:
+        key = (set_id, profile_sets.version(set_id), digest, top_k, vad, cascade)
+    except UnknownProfileSet:
+        raise HTTPException(404, f"Unknown profile set {set_id}")
+    result, response.headers["X-Cache"] = await results.get_or_run(
+        key, lambda: _run_in_pool(_identify_job, audio_bytes, top_k, vad, timer, time.perf_counter(), profile_set,
+                                  cascade))
+    name, confidence, all_scores, speech, cascade_info = result
+    timer.add("total", time.perf_counter() - t0)
+    result = {
+        "name": name.replace("_", " "),
+        "confidence": f"{confidence:.4%}",
+        "all_scores": {k: f"{v:.4%}" for k, v in all_scores.items()},
+    }
+    if speech is not None:
+        result["speech"] = {k: round(v, 2) for k, v in speech.items()}
+    if cascade_info is not None:
+        result["cascade"] = cascade_info
+    if timings:
+        result["timings"] = timer.breakdown_ms()
+    return result
 
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
+# add clips to a new or existing speaker without retraining anyone else
+@app.post("/enroll")
+async def enroll_speaker(name: str = Form(...), files: List[UploadFile] = File(...), vad: bool = VAD_DEFAULT,
+                         profile_set: Optional[str] = None):
+    name = name.strip()
+    if not name:
+        raise HTTPException(400, "Please give a speaker name")
+    if any(not f.filename or not f.filename.lower().endswith(".wav") for f in files):
+        raise HTTPException(400, "Please upload .wav files")
+
+    clips = [await f.read() for f in files]
+    added, speakers = await _run_in_pool(_enroll_job, name, clips, vad, profile_set)
+    results.invalidate(profile_set or DEFAULT_SET)
+    return {"name": name, "added_files": added, "speakers": speakers}
+
+@app.delete("/enroll/{name}")
+async def remove_speaker(name: str, profile_set: Optional[str] = None):
+    if recognizer is None or not recognizer.ready:
+        raise HTTPException(503, load_error or "Model is still loading, try again shortly.")
+    try:
+        store = await asyncio.to_thread(_unenroll, name, profile_set)
+    except UnknownProfileSet:
+        raise HTTPException(404, f"Unknown profile set {profile_set}")
+    except KeyError:
+        raise HTTPException(404, f"{name} is not enrolled")
+    results.invalidate(profile_set or DEFAULT_SET)
+    return {"name": name, "removed": True, "speakers": len(store)}
+
+# kiosk streaming: send binary frames of mono PCM (int16 or float32, little-endian) at sample_rate,
+# get a provisional {"name", "confidence", ...} back every `hop` seconds, then send the text
+# message "end" for the final answer
+@app.websocket("/ws/identify")
+async def identify_stream(websocket: WebSocket, sample_rate: int = 16000, format: str = "int16",
+                          window: float = 3.0, hop: float = 1.0, top_k: int = 3, profile_set: Optional[str] = None):
+    await websocket.accept()
+    if recognizer is None or not recognizer.ready:
+        await websocket.send_json({"error": load_error or "Model is still loading, try again shortly."})
+        await websocket.close(code=1013)
+        return
+    if format not in ("int16", "float32") or sample_rate <= 0 or window <= 0 or hop <= 0 or top_k < 1:
+        await websocket.send_json({"error": "Bad stream parameters"})
+        await websocket.close(code=1003)
+        return
+    try:
+        await asyncio.to_thread(profile_sets.get, profile_set)
+    except UnknownProfileSet:
+        await websocket.send_json({"error": f"Unknown profile set {profile_set}"})
+        await websocket.close(code=1008)
+        return
+
+    from streaming import StreamSession
+
+    session = StreamSession(sample_rate, window_sec=window, hop_sec=hop, min_sec=min(1.0, window))
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                session.push(message["bytes"], format)
+                if session.due():
+                    await _stream_update(websocket, session, top_k, profile_set, final=False)
+            elif message.get("text", "").strip().lower() in ("end", "stop"):
+                if session.pending():
+                    await _stream_update(websocket, session, top_k, profile_set, final=True)
+                elif session.windows:
+                    await _send_stream_result(websocket, session, top_k, profile_set, final=True)
+                else:
+                    await websocket.send_json({"final": True, "name": None, "detail": "Not enough audio"})
+                await websocket.close()
+                return
+    except NoSpeakersEnrolled as e:
+        await websocket.send_json({"error": str(e)})
+        await websocket.close(code=1008)
+    except QueueFull:
+        await websocket.send_json({"final": True, "error": "Server is busy, try again shortly."})
+        await websocket.close(code=1013)
+    except WebSocketDisconnect:
+        return
+
+
+async def _stream_update(websocket: WebSocket, session, top_k: int, profile_set: Optional[str], final: bool):
+    waveform = session.current_window()
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        name, confidence, all_scores = recognize(
-            PROFILES_PATH, file_path, language="english", max_duration=30
-        )
-        return {
-            "name": name.replace("_", " "),
-            "confidence": f"{confidence:.4%}",
-            "all_scores": {k: f"{v:.4%}" for k, v in sorted(all_scores.items(), key=lambda x: x[1], reverse=True)},
-        }
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        job = pool.submit(recognizer.embed, waveform, session.sample_rate)
+    except QueueFull:
+        # busy: skip this provisional update, the next hop will try again; the final one
+        # fails (see identify_stream) rather than running outside the pool
+        if final:
+            raise
+        return
+    emb = await asyncio.wrap_future(job)
+    session.add_embedding(emb)
+    await _send_stream_result(websocket, session, top_k, profile_set, final)
+
+
+async def _send_stream_result(websocket: WebSocket, session, top_k: int, profile_set: Optional[str], final: bool):
+    name, confidence, scores = recognizer.rank(session.emb_sum, top_k, store=profile_sets.get(profile_set))
+    await websocket.send_json({
+        "final": final,
+        "name": name.replace("_", " "),
+        "confidence": f"{confidence:.4%}",
+        "scores": {k: f"{v:.4%}" for k, v in scores.items()},
+        "audio_seconds": round(session.seconds, 2),
+        "windows": session.windows,
+    })
 
 @app.get("/", response_class=HTMLResponse, include_in_schema=False)
 async def home():
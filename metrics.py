@@ -0,0 +1,143 @@
+# per-stage timing and prometheus-format metrics (text exposition, no client library needed)
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+_registry = []
+
+
+def _labels(labels: tuple, extra: dict = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple, label_names: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple((k, labels[k]) for k in self.label_names)
+        with self._lock:
+            # [cumulative bucket counts..., count, sum]
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        for key, series in sorted(snapshot.items()):
+            for bound, c in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_labels(key, {'le': f'{bound:g}'})} {c}")
+            lines.append(f"{self.name}_bucket{_labels(key, {'le': '+Inf'})} {series[-2]}")
+            lines.append(f"{self.name}_sum{_labels(key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(key)} {series[-2]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple((k, labels[k]) for k in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time."""
+
+    def __init__(self, name: str, help_text: str, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        _registry.append(self)
+
+    def render(self) -> list:
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+STAGE_SECONDS = Histogram(
+    "echoai_stage_seconds", "Time spent in each stage of the recognition pipeline",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    label_names=("stage",),
+)
+AUDIO_SECONDS = Histogram(
+    "echoai_audio_seconds", "Seconds of audio embedded per clip",
+    buckets=(0.5, 1, 2, 3, 5, 10, 15, 20, 30, 60, 120),
+)
+CASCADE_DECISIONS = Counter("echoai_cascade_decisions_total", "Cascaded recognitions by the stage that decided",
+                            label_names=("stage",))
+CASCADE_AUDIO_SECONDS = Histogram(
+    "echoai_cascade_audio_seconds", "Seconds of audio embedded per cascaded recognition (all stages)",
+    buckets=(1, 2, 3, 5, 10, 15, 20, 30, 45, 60),
+)
+REQUESTS = Counter("echoai_requests_total", "Requests handled", label_names=("endpoint", "status"))
+Gauge("echoai_peak_rss_bytes", "Peak resident set size of this process", peak_rss_bytes)
+
+
+class StageTimer:
+    """Collects how long each stage of one request took (and records every stage in
+    STAGE_SECONDS as it goes). Stages that run more than once are summed."""
+
+    def __init__(self):
+        self.stages = {}
+        self.audio_seconds = 0.0
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+    def add_audio(self, seconds: float):
+        self.audio_seconds += seconds
+        AUDIO_SECONDS.observe(seconds)
+
+    def breakdown_ms(self) -> dict:
+        return {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
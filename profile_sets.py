@@ -0,0 +1,145 @@
+# several independent speaker groups (one per site) served by one process
+import glob
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from profile_store import ProfileStore, locked
+
+DEFAULT_SET = "default"
+_SET_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class UnknownProfileSet(KeyError):
+    pass
+
+
+class ProfileSets:
+    """Profile stores by set id, loaded on first use from <sets_dir>/<id>.pkl (the default
+    set lives at default_path).
+
+    Resident sets are kept in LRU order and the least recently used ones are dropped once
+    their matrices add up to more than max_mb. Every lookup compares the file's mtime with
+    the one that was loaded and reloads on a change; the new store is swapped in whole, so
+    requests already holding the old one finish with it undisturbed.
+
+    With shared_dir set, loaded stores are mapped from files there (ProfileStore.share),
+    so worker processes serving the same profiles hold one copy between them."""
+
+    def __init__(self, default_path: str, sets_dir: str = "profile_sets", max_mb: float = 1024,
+                 shared_dir: str = None):
+        self.default_path = default_path
+        self.sets_dir = sets_dir
+        self.shared_dir = shared_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._resident = OrderedDict()  # set id -> (store, mtime_ns, nbytes)
+        self._lock = threading.Lock()
+        self._set_locks = {}
+        self.reloads = 0
+
+    def path(self, set_id: str = None) -> str:
+        if set_id in (None, DEFAULT_SET):
+            return self.default_path
+        if not _SET_ID.match(set_id):
+            raise UnknownProfileSet(set_id)
+        return os.path.join(self.sets_dir, f"{set_id}.pkl")
+
+    def _set_lock(self, set_id: str) -> threading.RLock:
+        with self._lock:
+            return self._set_locks.setdefault(set_id, threading.RLock())
+
+    @staticmethod
+    def _nbytes(store: ProfileStore) -> int:
+        return store.matrix.nbytes + store.sums.nbytes
+
+    def _cached(self, set_id: str, mtime: int):
+        with self._lock:
+            entry = self._resident.get(set_id)
+            if entry is not None and entry[1] == mtime:
+                self._resident.move_to_end(set_id)
+                return entry[0]
+        return None
+
+    # one shared file per (profile file, version); older versions are removed, which doesn't
+    # disturb processes that still have them mapped
+    def _share(self, set_id: str, store: ProfileStore, mtime: int):
+        if self.shared_dir is None or not len(store):
+            return
+        prefix = hashlib.sha1(os.path.abspath(self.path(set_id)).encode()).hexdigest()[:16]
+        store.share(self.shared_dir, f"{prefix}-{mtime}")
+        for old in glob.glob(os.path.join(self.shared_dir, f"{prefix}-*.npy")):
+            version = os.path.basename(old)[len(prefix) + 1:-4]
+            if version.isdigit() and int(version) < mtime:
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+
+    def _install(self, set_id: str, store: ProfileStore, mtime: int):
+        self._share(set_id, store, mtime)
+        with self._lock:
+            if set_id in self._resident:
+                self.reloads += 1
+            self._resident[set_id] = (store, mtime, self._nbytes(store))
+            self._resident.move_to_end(set_id)
+            while len(self._resident) > 1 and self.resident_bytes > self.max_bytes:
+                self._resident.popitem(last=False)
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(nbytes for _, _, nbytes in self._resident.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"resident": list(self._resident), "resident_mb": round(self.resident_bytes / 2 ** 20, 2),
+                    "max_mb": round(self.max_bytes / 2 ** 20, 2), "reloads": self.reloads}
+
+    # changes whenever the set's file is replaced (saves swap in a new file) or touched
+    def version(self, set_id: str = None) -> tuple:
+        try:
+            st = os.stat(self.path(set_id))
+        except FileNotFoundError:
+            raise UnknownProfileSet(set_id or DEFAULT_SET)
+        return st.st_ino, st.st_mtime_ns
+
+    # a store that was already loaded for the default set (e.g. by the Recognizer)
+    def adopt(self, store: ProfileStore, set_id: str = DEFAULT_SET):
+        self._install(set_id, store, os.stat(self.path(set_id)).st_mtime_ns)
+
+    def get(self, set_id: str = None) -> ProfileStore:
+        set_id = set_id or DEFAULT_SET
+        path = self.path(set_id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            raise UnknownProfileSet(set_id)
+        store = self._cached(set_id, mtime)
+        if store is not None:
+            return store
+        # one loader per set; other sets (and requests using the old copy) aren't held up
+        with self._set_lock(set_id):
+            store = self._cached(set_id, mtime)
+            if store is None:
+                store = ProfileStore.load(path)
+                self._install(set_id, store, mtime)
+        return store
+
+    # copy-on-write change to one set: `change(store)` edits a fresh copy read from disk under
+    # the file lock (other worker processes may have saved since our copy was loaded), which
+    # is saved and swapped in. With create=True a missing set starts out empty.
+    def update(self, set_id: str, change, create: bool = False) -> ProfileStore:
+        set_id = set_id or DEFAULT_SET
+        path = self.path(set_id)
+        with self._set_lock(set_id), locked(path):
+            if os.path.isfile(path):
+                store = ProfileStore.load(path)
+            elif create:
+                store = ProfileStore([], [], [])
+            else:
+                raise UnknownProfileSet(set_id)
+            change(store)
+            store.save(path)
+            self._install(set_id, store, os.stat(path).st_mtime_ns)
+        return store
@@ -0,0 +1,202 @@
+# speaker profiles as one normalized matrix so scoring is a single matmul
+import fcntl
+import os
+import pickle
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+from ann_index import IVFIndex, index_path
+
+_STORE_KEYS = ('names', 'matrix', 'sums', 'counts', 'speakers', 'profiles')
+
+
+class NoSpeakersEnrolled(ValueError):
+    pass
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / (norms + 1e-8)
+
+
+# exclusive lock on <path>.lock for a load-change-save of a profiles file, held across
+# processes (api workers, train_speaker_model.py --add) so no change overwrites another
+@contextmanager
+def locked(path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".lock", 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ProfileStore:
+    """Speaker names plus an (N, D) float32 matrix of L2-normalized profile embeddings.
+    Row i of the matrix belongs to names[i].
+
+    Alongside the matrix the store keeps each speaker's embedding sum and file count,
+    so speakers can be added, extended or removed without re-embedding anyone else.
+    `meta` carries the rest of the pickle (train/test file lists) through load/save.
+    `ann` is an optional IVFIndex saved next to the pickle (see ann_index.py)."""
+
+    def __init__(self, names: list, sums: np.ndarray, counts, meta: dict = None):
+        self.names = list(names)
+        self.sums = np.asarray(sums, dtype=np.float32)
+        if self.names:
+            self.sums = self.sums.reshape(len(self.names), -1)
+        self.counts = np.asarray(counts, dtype=np.int64).reshape(len(self.names))
+        self.matrix = _normalize(self.sums)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.meta = meta or {}
+        self.ann = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_sums(cls, sums: dict, counts: dict, meta: dict = None) -> "ProfileStore":
+        names = list(sums.keys())
+        matrix = np.stack([np.asarray(sums[n], dtype=np.float32).flatten() for n in names])
+        return cls(names, matrix, [counts[n] for n in names], meta)
+
+    # older pickles only kept each speaker's average, so rebuild the sums from the
+    # number of training files (or 1 when that isn't recorded)
+    @classmethod
+    def from_profiles(cls, profiles: dict, meta: dict = None) -> "ProfileStore":
+        train_data = (meta or {}).get('train_data', {})
+        counts = {n: max(1, len(train_data.get(n, []))) for n in profiles}
+        sums = {n: np.asarray(profiles[n], dtype=np.float32).flatten() * counts[n] for n in profiles}
+        return cls.from_sums(sums, counts, meta)
+
+    # reads both the matrix format and the older {'profiles': {name: embedding}} pickles
+    @classmethod
+    def load(cls, path: str) -> "ProfileStore":
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        meta = {k: v for k, v in data.items() if k not in _STORE_KEYS}
+        if 'sums' in data:
+            store = cls(data['names'], data['sums'], data['counts'], meta)
+        elif 'matrix' in data:
+            store = cls.from_profiles(dict(zip(data['names'], data['matrix'])), meta)
+        else:
+            store = cls.from_profiles(data['profiles'], meta)
+        # an index built for a different set of speakers is ignored (exact search is used)
+        if os.path.isfile(index_path(path)):
+            ann = IVFIndex.load(index_path(path))
+            if ann.names == store.names:
+                store.ann = ann
+            else:
+                print(f"Warning: {index_path(path)} doesn't match the profiles, ignoring it")
+        return store
+
+    # written to a temp file and renamed, so readers never see a half-written store
+    def save(self, path: str, **extra):
+        meta = {**self.meta, **extra}
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(suffix=".pkl", dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({
+                'names': self.names,
+                'matrix': self.matrix,
+                'sums': self.sums,
+                'counts': self.counts,
+                'speakers': self.names,
+                **meta,
+            }, f)
+        os.replace(tmp, path)
+        if self.ann is not None:
+            self.ann.save(index_path(path))
+
+    # moves the sums and matrix into <directory>/<key>.npy and maps that file read-only, so
+    # every process serving the same profiles reads one copy from the page cache. The arrays
+    # can't be edited in place afterwards; changes go through copy(), which makes private ones.
+    def share(self, directory: str, key: str) -> "ProfileStore":
+        path = os.path.join(directory, key + ".npy")
+        if not os.path.isfile(path):
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(suffix=".npy", dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.stack([self.sums, self.matrix]))
+            os.replace(tmp, path)
+        try:
+            shared = np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            # another process replaced it with a newer version just now; keep our own arrays
+            return self
+        self.sums, self.matrix = shared[0], shared[1]
+        return self
+
+    def copy(self) -> "ProfileStore":
+        meta = {k: (dict(v) if isinstance(v, dict) else v) for k, v in self.meta.items()}
+        store = ProfileStore(self.names, self.sums.copy(), self.counts.copy(), meta)
+        if self.ann is not None:
+            store.ann = IVFIndex(self.ann.centroids, self.ann.assign.copy(), self.ann.names)
+        return store
+
+    # adds emb_sum (the sum of `count` new file embeddings) to a speaker, creating it if needed
+    def add(self, name: str, emb_sum: np.ndarray, count: int, files: list = None):
+        emb_sum = np.asarray(emb_sum, dtype=np.float32).flatten()
+        if name in self.index:
+            i = self.index[name]
+            self.sums[i] += emb_sum
+            self.counts[i] += count
+            self.matrix[i] = _normalize(self.sums[i])
+        else:
+            rows = [self.sums] if self.names else []
+            self.names.append(name)
+            self.index[name] = len(self.names) - 1
+            self.sums = np.vstack(rows + [emb_sum[None, :]])
+            self.counts = np.append(self.counts, count)
+            self.matrix = _normalize(self.sums) if len(rows) == 0 else np.vstack([self.matrix, _normalize(emb_sum)[None, :]])
+            if self.ann is not None:
+                self.ann.add_row(self.matrix[-1], name)
+        if files:
+            self.meta.setdefault('train_data', {}).setdefault(name, [])
+            self.meta['train_data'][name] = list(self.meta['train_data'][name]) + list(files)
+
+    def remove(self, name: str):
+        i = self.index[name]
+        del self.names[i]
+        self.sums = np.delete(self.sums, i, axis=0)
+        self.counts = np.delete(self.counts, i)
+        self.matrix = np.delete(self.matrix, i, axis=0)
+        self.index = {n: j for j, n in enumerate(self.names)}
+        if self.ann is not None:
+            self.ann.remove_row(i)
+        for key in ('train_data', 'test_data'):
+            self.meta.get(key, {}).pop(name, None)
+
+    # cosine similarity of one embedding against every profile
+    def score(self, emb: np.ndarray) -> np.ndarray:
+        emb = _normalize(np.asarray(emb).flatten())
+        return self.matrix @ emb
+
+    # best k (name, score) pairs, highest first, without sorting the whole array
+    def top_k(self, scores: np.ndarray, k: int = None) -> list:
+        return [(self.names[i], float(scores[i])) for i in _top_order(scores, k)]
+
+    # ranked (name, score) pairs; with n_probe and an index only the probed clusters are
+    # scored, so the list covers those candidates rather than every speaker. Probed lists
+    # can be empty (removed speakers, k-means leftovers); with fewer than k candidates
+    # (or none) it falls back to exact search
+    def search(self, emb: np.ndarray, k: int = None, n_probe: int = None) -> list:
+        if self.ann is None or not n_probe:
+            return self.top_k(self.score(emb), k)
+        query = _normalize(np.asarray(emb).flatten())
+        rows = self.ann.candidates(query, n_probe)
+        if len(rows) < min(max(k or 1, 1), len(self.names)):
+            return self.top_k(self.matrix @ query, k)
+        scores = self.matrix[rows] @ query
+        return [(self.names[rows[i]], float(scores[i])) for i in _top_order(scores, k)]
+
+
+def _top_order(scores: np.ndarray, k: int = None) -> np.ndarray:
+    if k is None or k >= len(scores):
+        return np.argsort(-scores)
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part])]
@@ -1,97 +1,654 @@
 # python script to compare& output scores
 import argparse
-import gc
+import glob
+import json
+import multiprocessing as mp
 import os
 import sys
-import tempfile
+import threading
+import time
 import soundfile as sf
 import torch
-import torchaudio
-import wespeaker
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import redirect_stdout
-import pickle
+from audio_io import install_torchaudio_patch, load_waveform, read_audio, resample
+from backends import BACKENDS, ExportedSpeaker, load_backend
+from embedding_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_MB, EmbeddingCache
+from inference import MicroBatcher
+from metrics import CASCADE_AUDIO_SECONDS, CASCADE_DECISIONS, StageTimer
+from profile_store import NoSpeakersEnrolled, ProfileStore
+from vad import EnergyVad, SpeechReport
 torch.set_num_threads(1)
 
 
-def patch_torchaudio_for_soundfile():
-    def custom_load(filepath, **kwargs):
-        data, sample_rate = sf.read(filepath)
-        tensor = torch.tensor(data).float()
-        if tensor.ndim == 1:
-            tensor = tensor.unsqueeze(0)
+# how much audio the VAD may look through to find max_duration seconds of speech
+VAD_SCAN_FACTOR = 4
+# cascade defaults: prefix lengths tried before the whole clip, and the top-1 minus top-2
+# score that ends the cascade early
+CASCADE_STAGES = (3.0, 10.0)
+CASCADE_MARGIN = 0.1
+
+# like load_waveform, but with a vad the first max_duration seconds of *speech* are kept;
+# also returns the vad stats (None without a vad)
+def load_speech(source, max_duration: float = None, vad: EnergyVad = None, timer: StageTimer = None):
+    timer = timer or StageTimer()
+    if vad is None:
+        with timer.stage("decode"):
+            waveform, sr = load_waveform(source, max_duration)
+        return waveform, sr, None
+    scan = max_duration * VAD_SCAN_FACTOR if max_duration and max_duration > 0 else None
+    with timer.stage("decode"):
+        waveform, sr = load_waveform(source, scan)
+    with timer.stage("vad"):
+        speech, stats = vad(waveform, sr, max_speech_sec=max_duration)
+    return speech, sr, stats
+
+
+_models = {}
+_model_lock = threading.RLock()
+
+# wespeaker (and whatever it pulls in) is only imported once a model is actually needed
+def model_version() -> str:
+    import wespeaker
+    return getattr(wespeaker, "__version__", "unknown")
+
+
+# wespeaker model per (language, backend), loaded on first use and kept for the rest of
+# the process; non-fp32 backends are derived from the fp32 model (see backends.py)
+def load_model(language: str = "english", backend: str = "fp32"):
+    with _model_lock:
+        if (language, backend) not in _models:
+            if backend == "fp32":
+                import wespeaker
+                install_torchaudio_patch()
+                with open(os.devnull, 'w') as f, redirect_stdout(f):
+                    _models[language, backend] = wespeaker.load_model(language)
+            else:
+                _models[language, backend] = load_backend(load_model(language), language, backend, model_version())
+        return _models[language, backend]
+
+
+# model exported by `backends.py --export`; needs neither wespeaker nor a checkpoint download
+def load_exported(path: str) -> ExportedSpeaker:
+    key = ("exported", os.path.abspath(path))
+    with _model_lock:
+        if key not in _models:
+            _models[key] = ExportedSpeaker(path)
+        return _models[key]
+
+
+# model identity for the embedding cache; fp32 keeps the plain version so existing entries stay valid
+def model_tag(backend: str = "fp32") -> str:
+    version = model_version()
+    return version if backend == "fp32" else f"{version}+{backend}"
+
+
+# embedding cache key for one file's bytes and everything that changes its embedding
+def cache_key(cache: EmbeddingCache, audio: bytes, language: str, max_duration: float = None,
+              vad: EnergyVad = None, backend: str = "fp32") -> str:
+    return cache.key(audio, language=language, model=model_tag(backend), max_duration=max_duration,
+                     vad=vad.settings() if vad else None)
+
+
+# embedding of a wav on disk; with a cache the model is only loaded (and run) on a miss.
+# vad stats for files that actually got decoded are added to `report`
+def embed_file(path: str, language: str = "english", max_duration: float = None,
+               cache: EmbeddingCache = None, model=None, vad: EnergyVad = None,
+               report: SpeechReport = None, timer: StageTimer = None, backend: str = "fp32") -> np.ndarray:
+    timer = timer or StageTimer()
+    if cache is None:
+        waveform, sr, stats = load_speech(path, max_duration, vad, timer)
+    else:
+        with timer.stage("cache_lookup"):
+            audio = read_audio(path)
+            key = cache_key(cache, audio, language, max_duration, vad, backend)
+            emb = cache.get(key)
+        if emb is not None:
+            return emb
+        waveform, sr, stats = load_speech(audio, max_duration, vad, timer)
+    if report is not None:
+        report.add(stats)
+    model = model or load_model(language, backend)
+    timer.add_audio(waveform.shape[-1] / sr)
+    with timer.stage("resample"):
+        waveform, sr = resample(waveform, sr, model.resample_rate), model.resample_rate
+    with timer.stage("embed"):
+        emb = np.asarray(model.extract_embedding_from_pcm(waveform, sr)).flatten()
+    if cache is not None:
+        cache.put(key, emb)
+    return emb
+
+
+# one forward pass over equal-length fbank matrices -> (N, D) embeddings
+def forward_batch(model, feats_list: list) -> np.ndarray:
+    batch = torch.stack(feats_list).to(model.device)
+    with torch.no_grad():
+        outputs = model.model(batch)
+        outputs = outputs[-1] if isinstance(outputs, tuple) else outputs
+    return outputs.to(torch.device('cpu')).numpy()
+
+
+# cache key + cached embedding, or cache key + fbank features and vad stats for a miss
+def _prepare_file(path: str, load, language: str, max_duration: float, cache: EmbeddingCache, vad: EnergyVad,
+                  backend: str):
+    audio = read_audio(path)
+    key = cache_key(cache, audio, language, max_duration, vad, backend) if cache is not None else None
+    emb = cache.get(key) if cache is not None else None
+    if emb is not None:
+        return key, emb, None, None
+    waveform, sr, stats = load_speech(audio, max_duration, vad)
+    model = load()
+    waveform = resample(waveform, sr, model.resample_rate)
+    return key, None, model.compute_fbank(waveform, sample_rate=model.resample_rate, cmn=True), stats
+
+
+# offline counterpart of embed_file for many files: cached embeddings come straight from the
+# cache, the rest are decoded chunk_size files at a time (on `threads` threads) and run through
+# the model batch_size clips at a time, grouped by exact fbank length so there's no padding and
+# every embedding matches embed_file's. The forward passes use `threads` torch threads.
+# Returns {path: embedding} for the files that could be processed
+def embed_files(paths: list, language: str = "english", max_duration: float = None, cache: EmbeddingCache = None,
+                vad: EnergyVad = None, report: SpeechReport = None, backend: str = "fp32", batch_size: int = 32,
+                threads: int = 1, chunk_size: int = 256, model=None) -> dict:
+    # the model is only loaded once something misses the cache
+    load = (lambda: model) if model is not None else (lambda: load_model(language, backend))
+    embs = {}
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        for start in range(0, len(paths), chunk_size):
+            chunk = paths[start:start + chunk_size]
+            jobs = [pool.submit(_prepare_file, p, load, language, max_duration, cache, vad, backend) for p in chunk]
+            by_length = {}
+            for path, job in zip(chunk, jobs):
+                try:
+                    key, emb, feats, stats = job.result()
+                except Exception as e:
+                    print(f"  Warning: Could not process {path}: {e}")
+                    continue
+                if emb is not None:
+                    embs[path] = emb
+                    continue
+                if report is not None:
+                    report.add(stats)
+                by_length.setdefault(feats.shape[0], []).append((path, key, feats))
+            if not by_length:
+                continue
+            torch_threads = torch.get_num_threads()
+            torch.set_num_threads(max(1, threads))
+            try:
+                for items in by_length.values():
+                    for i in range(0, len(items), batch_size):
+                        group = items[i:i + batch_size]
+                        for (path, key, _), emb in zip(group, forward_batch(load(), [f for _, _, f in group])):
+                            embs[path] = np.asarray(emb).flatten()
+                            if cache is not None:
+                                cache.put(key, embs[path])
+            finally:
+                torch.set_num_threads(torch_threads)
+    return embs
+
+
+class CascadeReport:
+    """Running totals of cascaded recognitions: which stage decided and how much audio was embedded."""
+
+    def __init__(self):
+        self.requests = 0
+        self.audio_sec = 0.0
+        self.by_stage = {}
+        self._lock = threading.Lock()
+
+    def add(self, info: dict):
+        with self._lock:
+            self.requests += 1
+            self.audio_sec += info["audio_sec"]
+            self.by_stage[info["stage"]] = self.by_stage.get(info["stage"], 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "decided_by_stage": dict(sorted(self.by_stage.items())),
+                    "avg_audio_sec": round(self.audio_sec / self.requests, 3) if self.requests else None}
+
+
+class Recognizer:
+    """Keeps the wespeaker model (one per language) and the speaker profiles in memory,
+    so repeated calls only pay for the embedding + scoring.
+
+    With model_path (an artifact from `backends.py --export`) that model is used for its
+    own language instead of loading wespeaker."""
+
+    def __init__(self, profiles_path: str, language: str = "english", cache: EmbeddingCache = None,
+                 vad: EnergyVad = None, n_probe: int = None, backend: str = "fp32", model_path: str = None):
+        self.profiles_path = profiles_path
+        self.language = language
+        self.backend = backend
+        self.model_path = model_path
+        self.cache = cache
+        self.vad = vad
+        self.n_probe = n_probe
+        self.report = SpeechReport()
+        self.cascade_report = CascadeReport()
+        self.ready = False
+        self.batcher = None
+        self.profiles = ProfileStore.load(profiles_path)
+
+    def model(self, language: str = None):
+        if self.model_path:
+            exported = load_exported(self.model_path)
+            if exported.language == (language or self.language):
+                return exported
+        return load_model(language or self.language, self.backend)
+
+    # load the model and push one short clip through it so the first real request is fast
+    def warmup(self, language: str = None):
+        noise = torch.randn(1, 16000) * 0.01
+        self.embed_features([self.features(noise, 16000, language)], language)
+        self.ready = True
+
+    # route default-language embeddings through a MicroBatcher shared by all callers
+    def enable_batching(self, max_batch_size: int = 8, max_wait_ms: float = 5.0, bucket_frames: int = 50):
+        if max_batch_size > 1:
+            self.batcher = MicroBatcher(self.embed_features, max_batch_size, max_wait_ms, bucket_frames)
+
+    # fbank features for one clip, same as wespeaker's extract_embedding_from_pcm
+    def features(self, waveform: torch.Tensor, sample_rate: int, language: str = None,
+                 timer: StageTimer = None) -> torch.Tensor:
+        timer = timer or StageTimer()
+        model = self.model(language)
+        if sample_rate != model.resample_rate:
+            with timer.stage("resample"):
+                waveform = resample(waveform, sample_rate, model.resample_rate)
+        with timer.stage("fbank"):
+            return model.compute_fbank(waveform, sample_rate=model.resample_rate, cmn=True)
+
+    # one forward pass over equal-length feature matrices -> one embedding per clip
+    def embed_features(self, feats_list: list, language: str = None) -> list:
+        return list(forward_batch(self.model(language), feats_list))
+
+    # with the batcher, time in the shared forward pass counts as "forward" and the rest of
+    # the wait (collecting the batch, other length groups going first) as "batch_wait"
+    def embed(self, waveform: torch.Tensor, sample_rate: int, language: str = None, batch: bool = True,
+              timer: StageTimer = None) -> np.ndarray:
+        timer = timer or StageTimer()
+        timer.add_audio(waveform.shape[-1] / sample_rate)
+        feats = self.features(waveform, sample_rate, language, timer)
+        if batch and self.batcher is not None and language in (None, self.language):
+            t0 = time.perf_counter()
+            fut = self.batcher.submit(feats)
+            emb = fut.result()
+            timer.add("forward", fut.forward_seconds)
+            timer.add("batch_wait", max(0.0, time.perf_counter() - t0 - fut.forward_seconds))
+            return emb
+        with timer.stage("forward"):
+            return self.embed_features([feats], language)[0]
+
+    # returns (best name, best score, {name: score}) with only the top_k scores if given;
+    # scored against `store` instead of the recognizer's own profiles when one is passed
+    def identify(self, waveform: torch.Tensor, sample_rate: int, language: str = None, top_k: int = None,
+                 timer: StageTimer = None, store: ProfileStore = None):
+        timer = timer or StageTimer()
+        return self.rank(self.embed(waveform, sample_rate, language, timer=timer), top_k, timer, store)
+
+    # early exit: embed the first stages[0] seconds and stop if the best speaker leads the
+    # runner-up by at least `margin`, otherwise go on to the next longer prefix; the whole
+    # clip is always the last stage. Returns identify()'s triple plus {"stage", "stages",
+    # "margin", "audio_sec"}, audio_sec counting every stage that was embedded
+    def identify_cascade(self, waveform: torch.Tensor, sample_rate: int, stages: tuple = None,
+                         margin: float = CASCADE_MARGIN, language: str = None, top_k: int = None,
+                         timer: StageTimer = None, store: ProfileStore = None):
+        timer = timer or StageTimer()
+        stages = stages or CASCADE_STAGES
+        total = waveform.shape[-1]
+        prefixes = sorted({int(s * sample_rate) for s in stages if 0 < int(s * sample_rate) < total}) + [total]
+        used = 0
+        for stage, frames in enumerate(prefixes, 1):
+            emb = self.embed(waveform[..., :frames], sample_rate, language, timer=timer)
+            used += frames
+            # at least two scores are needed for the margin
+            name, score, scores = self.rank(emb, None if top_k is None else max(top_k, 2), timer, store)
+            ranked = list(scores.values())
+            lead = ranked[0] - ranked[1] if len(ranked) > 1 else float("inf")
+            if lead >= margin or stage == len(prefixes):
+                break
+        if top_k is not None:
+            scores = dict(list(scores.items())[:top_k])
+        info = {"stage": stage, "stages": len(prefixes), "margin": round(lead, 6) if lead != float("inf") else None,
+                "audio_sec": round(used / sample_rate, 3)}
+        self.cascade_report.add(info)
+        CASCADE_DECISIONS.inc(stage=stage)
+        CASCADE_AUDIO_SECONDS.observe(info["audio_sec"])
+        return name, score, scores, info
+
+    def rank(self, emb: np.ndarray, top_k: int = None, timer: StageTimer = None, store: ProfileStore = None):
+        store = store if store is not None else self.profiles
+        if len(store) == 0:
+            raise NoSpeakersEnrolled("No speakers are enrolled")
+        with (timer or StageTimer()).stage("scoring"):
+            ranked = store.search(emb, top_k, n_probe=self.n_probe)
+        best_name, best_score = ranked[0]
+        return best_name, best_score, dict(ranked)
+
+    # with cascade=(prefix seconds, ...) the clip goes through identify_cascade and the result
+    # gets its info dict as a fourth element (the embedding cache isn't used then)
+    def recognize(self, audio_path: str, language: str = None, max_duration: float = None, top_k: int = None,
+                  timer: StageTimer = None, cascade: tuple = None, margin: float = CASCADE_MARGIN):
+        timer = timer or StageTimer()
+        if cascade is not None:
+            waveform, sr, stats = load_speech(audio_path, max_duration, self.vad, timer)
+            self.report.add(stats)
+            return self.identify_cascade(waveform, sr, cascade, margin, language, top_k, timer)
+        # cache keys name the wespeaker version, so an exported model skips the cache
+        if self.cache is not None and not self.model_path:
+            emb = embed_file(audio_path, language or self.language, max_duration, cache=self.cache,
+                             vad=self.vad, report=self.report, timer=timer, backend=self.backend)
+            return self.rank(emb, top_k, timer)
+        waveform, sr, stats = load_speech(audio_path, max_duration, self.vad, timer)
+        self.report.add(stats)
+        return self.identify(waveform, sr, language, top_k, timer)
+
+    # who is speaking in each window_sec window (every hop_sec) of a wav of any length. The
+    # file is read block by block and windows are embedded batch_size at a time, so memory
+    # stays flat however long the recording is. Yields {"start", "end", "name", "score",
+    # "scores"} per window in order; windows quieter than silence_db are yielded with
+    # name None and not embedded.
+    def timeline(self, audio_path: str, window_sec: float = 3.0, hop_sec: float = None, batch_size: int = 16,
+                 top_k: int = None, silence_db: float = -55.0):
+        sr = sf.info(audio_path).samplerate
+        window = int(window_sec * sr)
+        hop = int((hop_sec or window_sec) * sr)
+        if not 0 < hop <= window:
+            raise ValueError("hop must be positive and no longer than the window")
+        pending = []
+        start = 0
+        for block in sf.blocks(audio_path, blocksize=window, overlap=window - hop, dtype='float32', always_2d=True):
+            # the last block can be a short tail that earlier windows already mostly covered
+            if start and len(block) < window // 2:
+                break
+            record = {"start": start / sr, "end": (start + len(block)) / sr, "name": None, "score": None}
+            level_db = 10 * np.log10(np.mean(block ** 2) + 1e-10)
+            feats = None
+            if level_db >= silence_db:
+                feats = self.features(torch.from_numpy(np.ascontiguousarray(block.T)), sr)
+            pending.append((record, feats))
+            start += hop
+            if sum(f is not None for _, f in pending) >= batch_size:
+                yield from self._rank_windows(pending, top_k)
+                pending = []
+        yield from self._rank_windows(pending, top_k)
+
+    def _rank_windows(self, pending: list, top_k: int = None):
+        by_length = {}
+        for i, (_, feats) in enumerate(pending):
+            if feats is not None:
+                by_length.setdefault(feats.shape[0], []).append(i)
+        for rows in by_length.values():
+            for i, emb in zip(rows, self.embed_features([pending[i][1] for i in rows])):
+                name, score, scores = self.rank(emb, top_k)
+                pending[i][0].update(name=name, score=score, scores=scores)
+        for record, _ in pending:
+            yield record
+
+
+# consecutive windows with the same speaker folded into one segment
+def merge_segments(windows):
+    current = None
+    for w in windows:
+        if current is not None and w["name"] == current["name"]:
+            current["end"] = w["end"]
+            current["windows"] += 1
+            if w["score"] is not None:
+                current["score_sum"] += w["score"]
+            continue
+        if current is not None:
+            yield _finish_segment(current)
+        current = {"start": w["start"], "end": w["end"], "name": w["name"], "windows": 1,
+                   "score_sum": w["score"] or 0.0}
+    if current is not None:
+        yield _finish_segment(current)
+
+
+def _finish_segment(segment: dict) -> dict:
+    score_sum = segment.pop("score_sum")
+    segment["mean_score"] = score_sum / segment["windows"] if segment["name"] is not None else None
+    return segment
+
+
+def _clock(seconds: float) -> str:
+    minutes, sec = divmod(seconds, 60)
+    return f"{int(minutes // 60):02d}:{int(minutes % 60):02d}:{sec:04.1f}"
+
+
+_recognizers = {}
+
+# one resident recognizer per (profiles, language, options) for the whole process; the cache,
+# vad and n_probe are part of the key so a later call never silently gets an earlier call's ones
+def get_recognizer(profiles_path: str, language: str = "english", cache: EmbeddingCache = None,
+                   vad: EnergyVad = None, n_probe: int = None, backend: str = "fp32") -> Recognizer:
+    key = (os.path.abspath(profiles_path), language, backend, n_probe,
+           tuple(sorted(vad.settings().items())) if vad is not None else None,
+           os.path.abspath(cache.cache_dir) if cache is not None else None)
+    if key not in _recognizers:
+        _recognizers[key] = Recognizer(profiles_path, language, cache=cache, vad=vad, n_probe=n_probe,
+                                       backend=backend)
+    return _recognizers[key]
+
+
+def recognize(profiles_path: str, audio_path: str, language: str = "english", max_duration: float = None,
+              top_k: int = None, cache: EmbeddingCache = None, vad: EnergyVad = None, n_probe: int = None,
+              timer: StageTimer = None, backend: str = "fp32", cascade: tuple = None, margin: float = CASCADE_MARGIN):
+    rec = get_recognizer(profiles_path, language, cache=cache, vad=vad, n_probe=n_probe, backend=backend)
+    return rec.recognize(audio_path, max_duration=max_duration, top_k=top_k, timer=timer, cascade=cascade,
+                         margin=margin)
+
+
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg")
+
+# files named on the command line: files as given, directories searched recursively for audio,
+# patterns with glob characters expanded (** included). Sorted, duplicates dropped
+def expand_inputs(inputs: list) -> list:
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                paths.extend(os.path.join(root, f) for f in files if f.lower().endswith(AUDIO_EXTENSIONS))
+        elif glob.has_magic(item):
+            paths.extend(p for p in glob.glob(item, recursive=True) if os.path.isfile(p))
         else:
-            tensor = tensor.t()
-        return tensor, sample_rate
-    torchaudio.load = custom_load
-
-
-def cosine_similarity(emb1, emb2):
-    return float(np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2) + 1e-8))
-
-
-def _trim_and_get_path(path: str, max_duration: float):
-    if max_duration is None or max_duration <= 0:
-        return path, None
-    with sf.SoundFile(path) as f:
-        sr, n_total = f.samplerate, len(f)
-        n_read = min(int(max_duration * sr), n_total)
-        data = f.read(n_read)
-    fd, tmp = tempfile.mkstemp(suffix=".wav")
-    os.close(fd)
-    sf.write(tmp, data, sr)
-    del data
-    return tmp, tmp
-
-def recognize(profiles_path: str, audio_path: str, language: str = "english", max_duration: float = None):
-    patch_torchaudio_for_soundfile()
-    with open(os.devnull, 'w') as f, redirect_stdout(f):
-        model = wespeaker.load_model(language)
-
-    with open(profiles_path, 'rb') as f:
-        data = pickle.load(f)
-    profiles = data['profiles']
-    del data  
-
-    use_path, tmp_path = _trim_and_get_path(audio_path, max_duration)
+            paths.append(item)
+    return sorted({os.path.normpath(p) for p in paths})
+
+
+# files that already have a result line in a jsonl results file (a line cut off by an
+# interrupted run, or an error line, doesn't count, so that file is done again)
+def done_files(output: str) -> set:
+    done = set()
+    if os.path.isfile(output):
+        with open(output) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    if "name" in result:
+                        done.add(result["file"])
+                except (ValueError, KeyError, TypeError):
+                    pass
+    return done
+
+
+# each bulk worker process loads its recognizer once, on its first file
+_bulk_options = {}
+
+def _init_bulk_worker(options: dict):
+    torch.set_num_threads(1)
+    cache_dir, cache_max_mb = options.pop("cache_dir"), options.pop("cache_max_mb")
+    options["cache"] = EmbeddingCache(cache_dir, cache_max_mb) if cache_dir else None
+    _bulk_options.clear()
+    _bulk_options.update(options)
+
+
+def _bulk_recognize(path: str) -> dict:
+    o = _bulk_options
+    timer = StageTimer()
+    t0 = time.perf_counter()
     try:
-        emb = model.extract_embedding(use_path)
-        emb = np.asarray(emb).flatten()
-    finally:
-        if tmp_path:
-            os.unlink(tmp_path)
-    gc.collect()
+        name, conf, scores, *cascade = recognize(o["profiles_path"], path, o["language"], max_duration=o["max_duration"],
+                                                 top_k=o["top_k"], cache=o["cache"], vad=o["vad"], n_probe=o["n_probe"],
+                                                 timer=timer, backend=o["backend"], cascade=o["cascade"],
+                                                 margin=o["margin"])
+    except Exception as e:
+        return {"file": path, "error": f"{type(e).__name__}: {e}"}
+    result = {"file": path, "name": name, "confidence": round(conf, 6),
+              "top_k": [[n, round(v, 6)] for n, v in scores.items()],
+              "ms": round(1000 * (time.perf_counter() - t0), 1), "timings": timer.breakdown_ms()}
+    if cascade:
+        result["cascade"] = cascade[0]
+    return result
 
-    scores = {name: cosine_similarity(emb, prof) for name, prof in profiles.items()}
-    best_name, best_score = max(scores.items(), key=lambda x: x[1])
-    return best_name, best_score, scores
 
+# recognizes `paths` across `workers` processes (one model each) and writes one json line per
+# file to `out` as soon as it's done, so lines come in completion order. Files in `skip`
+# (already done by an earlier run) aren't touched. Returns counts for a summary
+def recognize_many(profiles_path: str, paths: list, out, workers: int = 1, language: str = "english",
+                   max_duration: float = None, top_k: int = None, cache: EmbeddingCache = None,
+                   vad: EnergyVad = None, n_probe: int = None, backend: str = "fp32", skip: set = frozenset(),
+                   cascade: tuple = None, margin: float = CASCADE_MARGIN) -> dict:
+    todo = [p for p in paths if p not in skip]
+    options = {"profiles_path": profiles_path, "language": language, "max_duration": max_duration, "top_k": top_k,
+               "vad": vad, "n_probe": n_probe, "backend": backend, "cascade": cascade, "margin": margin,
+               "cache_dir": cache.cache_dir if cache is not None else None,
+               "cache_max_mb": cache.max_bytes / (1024 * 1024) if cache is not None else 0}
+    counts = {"files": len(paths), "skipped": len(paths) - len(todo), "done": 0, "errors": 0}
+    report = CascadeReport()
+    t0 = time.perf_counter()
+    if workers > 1 and len(todo) > 1:
+        pool = mp.Pool(min(workers, len(todo)), initializer=_init_bulk_worker, initargs=(options,))
+        results = pool.imap_unordered(_bulk_recognize, todo)
+    else:
+        pool = None
+        _init_bulk_worker(options)
+        results = map(_bulk_recognize, todo)
+    try:
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            counts["done"] += 1
+            counts["errors"] += "error" in result
+            if "cascade" in result:
+                report.add(result["cascade"])
+    finally:
+        if pool is not None:
+            pool.terminate()
+    elapsed = time.perf_counter() - t0
+    counts["seconds"] = round(elapsed, 2)
+    counts["files_per_sec"] = round(counts["done"] / elapsed, 2) if elapsed > 0 else None
+    if report.requests:
+        counts["cascade"] = report.stats()
+    return counts
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Recognize speaker from audio file")
-    parser.add_argument("audio_file", help="Path to WAV file")
+    parser.add_argument("audio_file", nargs="+", help="Path to WAV file; several files, directories or globs write JSONL")
     parser.add_argument("--profiles", default="speaker_profiles.pkl", help="Path to speaker profiles")
     parser.add_argument("--language", default="english", choices=["english", "chinese"])
     parser.add_argument("--info", action="store_true", help="Show confidence and all scores")
     parser.add_argument("--max_duration", type=float, default=30, help="Use first N sec of audio (default 30, 0=full)")
+    parser.add_argument("--top_k", type=int, default=None, help="Only show the N best scores with --info (JSONL: default 5)")
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR, help="Embedding cache directory")
+    parser.add_argument("--cache_max_mb", type=float, default=DEFAULT_MAX_MB, help="Embedding cache size cap in MB")
+    parser.add_argument("--no_cache", action="store_true", help="Don't read or write the embedding cache")
+    parser.add_argument("--vad", action="store_true", help="Drop silence/music and use the first max_duration sec of speech")
+    parser.add_argument("--vad_threshold_db", type=float, default=-35.0, help="VAD level relative to the loudest frame")
+    parser.add_argument("--n_probe", type=int, default=None, help="Use the ANN index, searching N clusters (default: exact)")
+    parser.add_argument("--backend", default="fp32", choices=BACKENDS, help="Embedding model variant (jit/int8 are faster on CPU)")
+    parser.add_argument("--timings", action="store_true", help="Print how long each stage took")
+    parser.add_argument("--timeline", action="store_true", help="Label the whole file window by window (any length)")
+    parser.add_argument("--window", type=float, default=3.0, help="Timeline window in seconds")
+    parser.add_argument("--hop", type=float, default=None, help="Timeline step in seconds (default: window)")
+    parser.add_argument("--batch_size", type=int, default=16, help="Timeline windows per forward pass")
+    parser.add_argument("--cascade", type=float, nargs="*", default=None,
+                        help=f"Early exit: score these prefix lengths (sec) before the whole clip (default {CASCADE_STAGES})")
+    parser.add_argument("--margin", type=float, default=CASCADE_MARGIN, help="Top-1 minus top-2 score that ends the cascade")
+    parser.add_argument("--workers", type=int, default=1, help="Processes for many files (each loads the model once)")
+    parser.add_argument("--output", default=None, help="Append JSONL results here; files already in it are skipped")
     args = parser.parse_args()
+    if args.cascade is not None:
+        args.cascade = tuple(args.cascade) or CASCADE_STAGES
+
+    md = None if args.max_duration == 0 else args.max_duration
+    cache = None if args.no_cache else EmbeddingCache(args.cache_dir, args.cache_max_mb)
+    vad = EnergyVad(threshold_db=args.vad_threshold_db) if args.vad else None
+
+    # bulk mode: one json line per file (stdout or --output), progress on stderr
+    first = args.audio_file[0]
+    if len(args.audio_file) > 1 or os.path.isdir(first) or glob.has_magic(first) or args.output or args.workers > 1:
+        if args.timeline:
+            parser.error("--timeline takes a single file")
+        paths = expand_inputs(args.audio_file)
+        skip = done_files(args.output) if args.output else set()
+        out = open(args.output, 'a') if args.output else sys.stdout
+        if args.output and out.tell() > 0:
+            with open(args.output, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    out.write("\n")  # finish a line cut off by an interrupted run
+        try:
+            counts = recognize_many(args.profiles, paths, out, args.workers, args.language, max_duration=md,
+                                    top_k=args.top_k or 5, cache=cache, vad=vad, n_probe=args.n_probe,
+                                    backend=args.backend, skip=skip, cascade=args.cascade, margin=args.margin)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print(f"{counts['done']} files recognized ({counts['errors']} errors), {counts['skipped']} already done, "
+              f"{counts['files_per_sec']} files/s", file=sys.stderr)
+        if "cascade" in counts:
+            s = counts["cascade"]
+            print(f"Cascade: decided by stage {s['decided_by_stage']}, {s['avg_audio_sec']}s of audio embedded on average",
+                  file=sys.stderr)
+        sys.exit(0)
+    args.audio_file = first
+
+    if args.timeline:
+        # with --info every window is listed, otherwise runs of the same speaker are merged
+        rec = get_recognizer(args.profiles, args.language, n_probe=args.n_probe, backend=args.backend)
+        windows = rec.timeline(args.audio_file, args.window, args.hop, args.batch_size, top_k=args.top_k)
+        for seg in (windows if args.info else merge_segments(windows)):
+            name = seg["name"].replace('_', ' ') if seg["name"] is not None else "(silence)"
+            score = seg["score"] if args.info else seg["mean_score"]
+            print(f"{_clock(seg['start'])} - {_clock(seg['end'])}  {name:<25} "
+                  f"{'' if score is None else f'{score:.2%}'}")
+        sys.exit(0)
 
     if not args.info:
         sys.stdout = open(os.devnull, 'w')
 
-    md = None if args.max_duration == 0 else args.max_duration
-    name, conf, all_scores = recognize(args.profiles, args.audio_file, args.language, max_duration=md)
+    timer = StageTimer()
+    t0 = time.perf_counter()
+    name, conf, all_scores, *cascade_info = recognize(args.profiles, args.audio_file, args.language, max_duration=md,
+                                                      top_k=args.top_k, cache=cache, vad=vad, n_probe=args.n_probe,
+                                                      timer=timer, backend=args.backend, cascade=args.cascade,
+                                                      margin=args.margin)
+    total_s = time.perf_counter() - t0
     
     if not args.info:
         sys.stdout = sys.__stdout__
 
     print(f"\nHello {name.replace('_', ' ')}!")
 
+    if args.timings:
+        # total includes the model load on a first call, which isn't one of the stages
+        print(f"Timings (ms, total {total_s * 1000:.1f}): {timer.breakdown_ms()}")
+
     if args.info:
         print(f"Confidence: {conf:.4%}")
-        print(f"{"SPEAKER NAME":<25} | {"SIMILARITY SCORE":>12}")
+        if cascade_info:
+            info = cascade_info[0]
+            lead = "n/a" if info["margin"] is None else f"{info['margin']:.4f}"
+            print(f"Decided at stage {info['stage']} of {info['stages']} after {info['audio_sec']:.1f}s of audio (lead {lead})")
+        report = get_recognizer(args.profiles, args.language, cache=cache, vad=vad, n_probe=args.n_probe,
+                                backend=args.backend).report
+        if report.files:
+            print(report.summary())
+        print(f"{'SPEAKER NAME':<25} | {'SIMILARITY SCORE':>12}")
         print("-"*40)
 
-        sorted_scores = dict(sorted(all_scores.items(), key=lambda item: item[1], reverse=True))
-        for s_name, s_score in sorted_scores.items():
+        for s_name, s_score in all_scores.items():
             print(f" {s_name:<25}: {s_score:.4%}")
\ No newline at end of file
@@ -0,0 +1,74 @@
+# /identify answers for clips we've already seen (kiosks and retrying clients re-send the same bytes)
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+
+from metrics import Counter
+
+RESULT_CACHE = Counter("echoai_result_cache_total", "/identify result cache lookups", label_names=("result",))
+
+
+def audio_digest(audio_bytes: bytes) -> str:
+    return hashlib.sha256(audio_bytes).hexdigest()
+
+
+class ResultCache:
+    """LRU + TTL cache of results keyed by whatever the caller puts in the key (the audio
+    digest, request options and the profile version), used from the event loop only.
+
+    Identical requests that arrive while the first one is still running wait for its result
+    instead of starting their own job. The job runs as its own task, so one caller going away
+    doesn't cancel it for the rest. Failures are passed on to everyone waiting but not cached."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires at, result)
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, task.result())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # (result, "hit" | "coalesced" | "miss"); `compute` is a coroutine function run on a miss
+    async def get_or_run(self, key, compute):
+        if self.max_entries <= 0:
+            RESULT_CACHE.inc(result="miss")
+            return await compute(), "miss"
+        entry = self._lookup(key)
+        if entry is not None:
+            RESULT_CACHE.inc(result="hit")
+            return entry[1], "hit"
+        task = self._inflight.get(key)
+        status = "coalesced"
+        if task is None:
+            task = asyncio.ensure_future(compute())
+            task.add_done_callback(lambda t: self._store(key, t))
+            self._inflight[key] = task
+            status = "miss"
+        RESULT_CACHE.inc(result=status)
+        return await asyncio.shield(task), status
+
+    # drop everything for one profile set (keys are tuples whose first element is the set id)
+    def invalidate(self, set_id: str):
+        for key in [k for k in self._entries if k[0] == set_id]:
+            del self._entries[key]
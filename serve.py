@@ -0,0 +1,144 @@
+# multi-process api server: the model is loaded once and the workers are forked from it
+# python serve.py --workers 4 --port 8000
+#
+# `uvicorn main:app --workers N` loads the model N times. Here the parent loads it (and warms
+# it up) before forking, so the weights are shared copy-on-write, and the profile matrices are
+# mapped from files in --shared_dir, so reloads after an enroll stay shared too.
+import argparse
+import gc
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+
+# (rss, pss) bytes of one process; pss splits shared pages between the processes mapping them,
+# so summing it over the workers gives what the box really pays
+def process_memory(pid: int) -> tuple:
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:"):
+                values[parts[0]] = int(parts[1]) * 1024
+    return values["Rss:"], values["Pss:"]
+
+
+# pid plus all of its descendants (linux /proc)
+def process_tree(pid: int) -> list:
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children.get(p, []))
+    return tree
+
+
+def tree_memory(pid: int) -> dict:
+    rss = pss = n = 0
+    for p in process_tree(pid):
+        try:
+            r, s = process_memory(p)
+        except (OSError, KeyError):
+            continue
+        rss, pss, n = rss + r, pss + s, n + 1
+    return {"processes": n, "rss_mb": round(rss / 2 ** 20, 1), "pss_mb": round(pss / 2 ** 20, 1)}
+
+
+def _worker(sock: socket.socket, log_level: str, restarted: bool):
+    import uvicorn
+    import main
+
+    if restarted:
+        # startup time of a replacement worker counts from its fork, not the original import
+        main.STARTED = time.monotonic()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)
+    uvicorn.Server(uvicorn.Config(main.app, log_level=log_level)).run(sockets=[sock])
+
+
+def serve(host: str, port: int, workers: int, shared_dir: str, log_level: str = "info"):
+    import main
+
+    main.SHARED_DIR = shared_dir
+    main.preload()
+    # objects that exist now are never collected, so the gc doesn't write to (and un-share) their pages
+    gc.freeze()
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    print(f"Serving on {host}:{port} with {workers} workers (parent pid {os.getpid()})")
+
+    children = set()
+    stopping = False
+
+    def spawn(restarted: bool = False):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _worker(sock, log_level, restarted)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    # replace workers that die; stop once they've all exited after a signal
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, restarting")
+            time.sleep(1)
+            spawn(restarted=True)
+    sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the api from several forked worker processes")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes (default: cpu count)")
+    parser.add_argument("--shared_dir", default=None, help="Where shared profile matrices go (default: a temp dir in /dev/shm)")
+    parser.add_argument("--log_level", default="info")
+    args = parser.parse_args()
+
+    shared_dir = args.shared_dir or tempfile.mkdtemp(prefix="echoai-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    try:
+        serve(args.host, args.port, args.workers, shared_dir, args.log_level)
+    finally:
+        if args.shared_dir is None:
+            shutil.rmtree(shared_dir, ignore_errors=True)
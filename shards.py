@@ -0,0 +1,167 @@
+# labeled corpus packed into a few big files of ready-to-embed audio
+# python shards.py --data_dir labeled_samples --output packed --max_duration 30
+# then train/test with --data_dir packed
+#
+# Every clip is decoded, trimmed to max_duration, resampled to 16 kHz and written back to back
+# into shard-NNNNN.bin (raw float32 or int16 samples). packed/index.json lists each clip's
+# label, source file, shard, sample offset and length. Readers memory-map the shards, so a
+# training pass is a sequential read through a few files instead of thousands of opens+decodes.
+import argparse
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+import torch
+
+INDEX_NAME = "index.json"
+SAMPLE_RATE = 16000
+DTYPES = ("float32", "int16")
+
+
+# clips are named "<dir>/index.json#<n>" wherever a file path would go (train/test data,
+# profile metadata), so they flow through the same code as wav paths
+def clip_ref(index_path: str, i: int) -> str:
+    return f"{index_path}#{i}"
+
+
+def parse_ref(source):
+    if not isinstance(source, str) or "#" not in source:
+        return None
+    path, _, i = source.rpartition("#")
+    if not i.isdigit() or os.path.basename(path) != INDEX_NAME:
+        return None
+    return path, int(i)
+
+
+def index_file(path: str) -> str:
+    return os.path.join(path, INDEX_NAME) if os.path.isdir(path) else path
+
+
+def is_packed(path: str) -> bool:
+    return os.path.isfile(index_file(path)) and os.path.basename(index_file(path)) == INDEX_NAME
+
+
+class Shards:
+    """A packed corpus opened for reading: the index plus one read-only memory map per shard."""
+
+    def __init__(self, path: str):
+        self.index_path = index_file(path)
+        with open(self.index_path) as f:
+            self.index = json.load(f)
+        self.sample_rate = self.index["sample_rate"]
+        self.dtype = np.dtype(self.index["dtype"])
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        # copy-on-write maps so torch gets writable arrays without copying the samples
+        self.shards = [np.memmap(os.path.join(directory, name), dtype=self.dtype, mode='c')
+                       if os.path.getsize(os.path.join(directory, name)) else np.zeros(0, self.dtype)
+                       for name in self.index["shards"]]
+        self.clips = self.index["clips"]
+
+    # {label: [clip ref, ...]} in packing order (the same order load_labeled_data gave)
+    def labeled_data(self) -> dict:
+        speakers = {}
+        for i, clip in enumerate(self.clips):
+            speakers.setdefault(clip["label"], []).append(clip_ref(self.index_path, i))
+        return speakers
+
+    def samples(self, i: int, max_duration: float = None) -> np.ndarray:
+        clip = self.clips[i]
+        frames = clip["frames"]
+        if max_duration is not None and max_duration > 0:
+            frames = min(frames, int(max_duration * self.sample_rate))
+        return self.shards[clip["shard"]][clip["offset"]:clip["offset"] + frames]
+
+    # float32 (1, samples) tensor, like load_waveform gives for a mono file
+    def waveform(self, i: int, max_duration: float = None) -> torch.Tensor:
+        samples = self.samples(i, max_duration)
+        if self.dtype == np.int16:
+            samples = samples.astype(np.float32)
+            samples *= 1 / 32768.0
+        return torch.from_numpy(samples).unsqueeze(0)
+
+    # the clip as an in-memory wav file (for embedding cache keys and anything that wants bytes)
+    def wav_bytes(self, i: int) -> bytes:
+        data = self.samples(i).tobytes()
+        tag, bits = (1, 16) if self.dtype == np.int16 else (3, 32)
+        block = bits // 8
+        header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(data), b'WAVE', b'fmt ', 16, tag, 1,
+                             self.sample_rate, self.sample_rate * block, block, bits, b'data', len(data))
+        return header + data
+
+
+_open = {}
+_open_lock = threading.Lock()
+
+# one Shards per index per process
+def open_shards(path: str) -> Shards:
+    key = os.path.abspath(index_file(path))
+    with _open_lock:
+        if key not in _open:
+            _open[key] = Shards(key)
+        return _open[key]
+
+
+# decodes every clip of load_labeled_data(data_dir) and writes shards of about shard_mb each.
+# Only the first channel is kept (it's the one the fbank front end reads)
+def pack(data_dir: str, output: str, max_duration: float = None, dtype: str = "float32", shard_mb: float = 1024) -> dict:
+    from audio_io import load_waveform, resample
+    from train_speaker_model import load_labeled_data
+
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype {dtype!r}, expected one of {DTYPES}")
+    speakers = load_labeled_data(data_dir)
+    os.makedirs(output, exist_ok=True)
+    np_dtype = np.dtype(dtype)
+    max_bytes = int(shard_mb * 1024 * 1024)
+    shards, clips, skipped = [], [], []
+    f, written = None, 0
+    try:
+        for label, paths in speakers.items():
+            for path in paths:
+                try:
+                    waveform, sr = load_waveform(path, max_duration)
+                    samples = resample(waveform[:1], sr, SAMPLE_RATE)[0].numpy()
+                except Exception as e:
+                    print(f"  Warning: Could not process {path}: {e}")
+                    skipped.append(path)
+                    continue
+                if np_dtype == np.int16:
+                    samples = np.clip(np.round(samples * 32768.0), -32768, 32767)
+                data = samples.astype(np_dtype).tobytes()
+                if f is None or (written and written + len(data) > max_bytes):
+                    if f is not None:
+                        f.close()
+                    shards.append(f"shard-{len(shards):05d}.bin")
+                    f, written = open(os.path.join(output, shards[-1]), 'wb'), 0
+                f.write(data)
+                clips.append({"label": label, "source": path, "shard": len(shards) - 1,
+                              "offset": written // np_dtype.itemsize, "frames": len(samples)})
+                written += len(data)
+    finally:
+        if f is not None:
+            f.close()
+    index = {"sample_rate": SAMPLE_RATE, "dtype": dtype, "max_duration": max_duration,
+             "shards": shards, "clips": clips, "skipped": skipped}
+    tmp = os.path.join(output, INDEX_NAME + ".tmp")
+    with open(tmp, 'w') as out:
+        json.dump(index, out)
+    os.replace(tmp, os.path.join(output, INDEX_NAME))
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a labeled corpus into memory-mappable audio shards")
+    parser.add_argument("--data_dir", default="data/speakers", help="Directory with data/speakers/{name}/*.wav")
+    parser.add_argument("--output", default="packed", help="Directory for the shards and index.json")
+    parser.add_argument("--max_duration", type=float, default=30, help="Keep the first N sec of each file (default 30, 0=full)")
+    parser.add_argument("--dtype", default="float32", choices=DTYPES, help="Sample format (int16 halves the size)")
+    parser.add_argument("--shard_mb", type=float, default=1024, help="Approximate size of each shard")
+    args = parser.parse_args()
+
+    index = pack(args.data_dir, args.output, None if args.max_duration == 0 else args.max_duration, args.dtype,
+                 args.shard_mb)
+    total = sum(c["frames"] for c in index["clips"]) / SAMPLE_RATE
+    print(f"Packed {len(index['clips'])} clips ({total / 3600:.2f} h of audio, {len(index['skipped'])} skipped) "
+          f"from {len(set(c['label'] for c in index['clips']))} speakers into {len(index['shards'])} shards in {args.output}")
@@ -0,0 +1,63 @@
+# state for identifying a speaker from audio that arrives in chunks
+import numpy as np
+import torch
+
+
+class StreamSession:
+    """Buffers incoming mono PCM and decides when to embed.
+
+    Once min_sec of audio has arrived, the last window_sec seconds are embedded
+    every hop_sec seconds. Each window embedding is L2-normalized and added to a
+    running sum, so the provisional answer is scored on all the evidence so far
+    while the buffer itself never holds more than one window."""
+
+    def __init__(self, sample_rate: int = 16000, window_sec: float = 3.0, hop_sec: float = 1.0,
+                 min_sec: float = 1.0):
+        self.sample_rate = sample_rate
+        self.window = int(window_sec * sample_rate)
+        self.hop = max(1, int(hop_sec * sample_rate))
+        self.min_samples = int(min_sec * sample_rate)
+        self.buffer = np.zeros(0, dtype=np.float32)
+        # bytes of a sample split across two frames, kept for the next push
+        self.partial = b""
+        self.received = 0
+        self.embedded_until = 0
+        self.next_emit = self.min_samples
+        self.emb_sum = None
+        self.windows = 0
+
+    # pcm: raw little-endian int16 or float32 bytes
+    def push(self, data: bytes, fmt: str = "int16"):
+        dtype = np.dtype('<f4' if fmt == "float32" else '<i2')
+        data = self.partial + data
+        whole = len(data) - len(data) % dtype.itemsize
+        data, self.partial = data[:whole], data[whole:]
+        chunk = np.frombuffer(data, dtype=dtype).astype(np.float32)
+        if fmt != "float32":
+            chunk /= 32768.0
+        self.buffer = np.concatenate([self.buffer, chunk])[-self.window:]
+        self.received += len(chunk)
+
+    def due(self) -> bool:
+        return self.received >= self.next_emit
+
+    # audio not yet covered by an embedding (used to flush the tail when the stream ends)
+    def pending(self) -> bool:
+        return self.received > self.embedded_until and self.received >= self.sample_rate // 4
+
+    def current_window(self) -> torch.Tensor:
+        self.embedded_until = self.received
+        while self.next_emit <= self.received:
+            self.next_emit += self.hop
+        return torch.from_numpy(self.buffer.copy()).unsqueeze(0)
+
+    def add_embedding(self, emb: np.ndarray) -> np.ndarray:
+        emb = np.asarray(emb, dtype=np.float32).flatten()
+        emb = emb / (np.linalg.norm(emb) + 1e-8)
+        self.emb_sum = emb if self.emb_sum is None else self.emb_sum + emb
+        self.windows += 1
+        return self.emb_sum
+
+    @property
+    def seconds(self) -> float:
+        return self.received / self.sample_rate
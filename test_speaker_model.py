@@ -1,135 +1,219 @@
 # python script to calculate similarity
 import argparse
 import gc
-import os
-import pickle
-import tempfile
+import json
+import time
 from pathlib import Path
 
-import soundfile as sf
-import torch
-import wespeaker
 import numpy as np
+import torch
 
-torch.set_num_threads(1)
+from backends import BACKENDS
+from embedding_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_MB, EmbeddingCache
+from profile_store import ProfileStore
+from recognize_speaker import Recognizer, embed_files
+from vad import EnergyVad, SpeechReport
 
-def patch_torchaudio_for_soundfile():
-    import torchaudio
-    def custom_load(filepath, **kwargs):
-        data, sr = sf.read(filepath)
-        t = torch.tensor(data).float()
-        if t.ndim == 1:
-            t = t.unsqueeze(0)
-        else:
-            t = t.t()
-        return t, sr
-    torchaudio.load = custom_load
-
-
-def _trim_to_temp(path: str, max_duration: float):
-    if max_duration is None or max_duration <= 0:
-        return path, None
-    with sf.SoundFile(path) as f:
-        sr, n_total = f.samplerate, len(f)
-        n_read = min(int(max_duration * sr), n_total)
-        data = f.read(n_read)
-    fd, tmp = tempfile.mkstemp(suffix=".wav")
-    os.close(fd)
-    sf.write(tmp, data, sr)
-    del data
-    return tmp, tmp
-
-
-# calculate similarity (closer to 1 is more similar)
-def cosine_similarity(emb1: np.ndarray, emb2: np.ndarray) -> float:
-    return float(np.dot(emb1, emb2) / (np.linalg.norm(emb1) * np.linalg.norm(emb2) + 1e-8))
-
-# returns the closest match
-def recognize(model, profiles: dict, audio_path: str, max_duration: float = None) -> tuple:
-    use_path, tmp_path = _trim_to_temp(audio_path, max_duration)
-    try:
-        emb = model.extract_embedding(use_path)
-        emb = np.asarray(emb).flatten()
-    finally:
-        if tmp_path:
-            os.unlink(tmp_path)
-    scores = {name: cosine_similarity(emb, prof) for name, prof in profiles.items()}
-    best = max(scores.items(), key=lambda x: x[1])
-    return best[0], best[1], scores
+torch.set_num_threads(1)
 
 # run calculations & evaluate
-def run_test(profiles_path: str = "speaker_profiles.pkl", language: str = "english", max_duration: float = None):
-    patch_torchaudio_for_soundfile()
-    model = wespeaker.load_model(language)
+def run_test(profiles_path: str = "speaker_profiles.pkl", language: str = "english", max_duration: float = None,
+             cache: EmbeddingCache = None, vad: EnergyVad = None, backend: str = "fp32", batch_size: int = 32,
+             threads: int = 1):
     print(f"Loading profiles from {profiles_path}...")
-    with open(profiles_path, 'rb') as f:
-        data = pickle.load(f)
-    profiles = data['profiles']
-    test_data = data.get('test_data', {})
+    profiles = ProfileStore.load(profiles_path)
+    test_data = profiles.meta.get('test_data', {})
 
     if not test_data or all(len(v) == 0 for v in test_data.values()):
         print("No test data in profiles. Run with --data_dir to evaluate on new data.")
         return
     print("\nEvaluating on test data...")
+    report = SpeechReport()
+    embs = embed_files([p for paths in test_data.values() for p in paths], language, max_duration, cache=cache,
+                       vad=vad, report=report, backend=backend, batch_size=batch_size, threads=threads)
     correct = 0
     total = 0
     for true_speaker, paths in test_data.items():
         for path in paths:
-            pred, conf, scores = recognize(model, profiles, path, max_duration=max_duration)
+            if path not in embs:
+                continue
+            pred, conf = profiles.top_k(profiles.score(embs[path]), 1)[0]
             total += 1
             if pred == true_speaker:
                 correct += 1
             status = "✓" if pred == true_speaker else "✗"
             print(f"  {status} {Path(path).name}: true={true_speaker} pred={pred} conf={conf:.4%}")
-            gc.collect()
     accuracy = correct / total if total else 0
     print(f"\n--- Results ---")
     print(f"Accuracy: {correct}/{total} = {accuracy:.2%}")
+    if vad is not None:
+        print(report.summary())
     gc.collect()
 
 
-def run_test_on_directory(profiles_path: str, data_dir: str, language: str = "english", max_duration: float = None):
+def run_test_on_directory(profiles_path: str, data_dir: str, language: str = "english", max_duration: float = None,
+                          cache: EmbeddingCache = None, vad: EnergyVad = None, backend: str = "fp32",
+                          batch_size: int = 32, threads: int = 1):
     from train_speaker_model import load_labeled_data, train_test_split
 
-    print("Loading wespeaker model...")
-    patch_torchaudio_for_soundfile()
-    model = wespeaker.load_model(language)
-
-    with open(profiles_path, 'rb') as f:
-        data = pickle.load(f)
-    profiles = data['profiles']
+    profiles = ProfileStore.load(profiles_path)
 
     speakers = load_labeled_data(data_dir)
     _, test_data = train_test_split(speakers, test_ratio=0.2)
 
+    test_data = {k: v for k, v in test_data.items() if k in profiles.index}
+    report = SpeechReport()
+    embs = embed_files([p for paths in test_data.values() for p in paths], language, max_duration, cache=cache,
+                       vad=vad, report=report, backend=backend, batch_size=batch_size, threads=threads)
     correct = 0
     total = 0
     for true_speaker, paths in test_data.items():
-        if true_speaker not in profiles:
-            continue
         for path in paths:
-            pred, conf, _ = recognize(model, profiles, path, max_duration=max_duration)
+            if path not in embs:
+                continue
+            pred, conf = profiles.top_k(profiles.score(embs[path]), 1)[0]
             total += 1
             if pred == true_speaker:
                 correct += 1
             print(f"  {'✓' if pred == true_speaker else '✗'} {path}: pred={pred} conf={conf:.4%}")
-            gc.collect()
 
     if total:
         print(f"\nAccuracy: {correct}/{total} = {correct/total:.2%}")
+    if vad is not None:
+        print(report.summary())
     gc.collect()
 
 
+# EER and the score threshold where it happens: accept everything scoring >= threshold,
+# false accepts are impostor scores accepted, false rejects genuine scores rejected
+def equal_error_rate(genuine: np.ndarray, impostor: np.ndarray) -> tuple:
+    if len(genuine) == 0 or len(impostor) == 0:
+        return None, None
+    scores = np.concatenate([genuine, impostor])
+    labels = np.concatenate([np.ones(len(genuine)), np.zeros(len(impostor))])
+    order = np.argsort(-scores, kind='stable')
+    scores, labels = scores[order], labels[order]
+    far = np.cumsum(1 - labels) / len(impostor)
+    frr = 1 - np.cumsum(labels) / len(genuine)
+    i = int(np.argmin(np.abs(far - frr)))
+    return float((far[i] + frr[i]) / 2), float(scores[i])
+
+
+# batched evaluation of {speaker: [wav paths]}: one matrix multiply scores every test file
+# against every profile, then accuracy, EER, confusion matrix and per-speaker stats
+def evaluate(rec: Recognizer, test_data: dict, max_duration: float = None, cache: EmbeddingCache = None,
+             vad: EnergyVad = None, batch_size: int = 32, threads: int = 1) -> dict:
+    store = rec.profiles
+    truth_of = {p: name for name, paths in test_data.items() if name in store.index for p in paths}
+    report = SpeechReport()
+    t0 = time.perf_counter()
+    by_path = embed_files(list(truth_of), rec.language, max_duration, cache=cache, vad=vad, report=report,
+                          backend=rec.backend, batch_size=batch_size, threads=threads)
+    embed_s = time.perf_counter() - t0
+    paths = [p for p in truth_of if p in by_path]
+    embs = np.stack([by_path[p] for p in paths]) if paths else np.zeros((0, store.matrix.shape[1]), np.float32)
+
+    n = len(paths)
+    truth = np.array([store.index[truth_of[p]] for p in paths], dtype=np.int64)
+    embs = embs / (np.linalg.norm(embs, axis=1, keepdims=True) + 1e-8)
+    scores = embs @ store.matrix.T
+    pred = scores.argmax(axis=1) if n else truth
+    genuine = scores[np.arange(n), truth]
+    impostor_mask = np.ones_like(scores, dtype=bool)
+    impostor_mask[np.arange(n), truth] = False
+    eer, threshold = equal_error_rate(genuine, scores[impostor_mask])
+
+    # confusion matrix over the speakers that occur as a truth or a prediction
+    labels = sorted(set(truth.tolist()) | set(pred.tolist()))
+    pos = {j: k for k, j in enumerate(labels)}
+    confusion = np.zeros((len(labels), len(labels)), dtype=np.int64)
+    np.add.at(confusion, ([pos[j] for j in truth], [pos[j] for j in pred]), 1)
+
+    speakers = {}
+    for j in sorted(set(truth.tolist())):
+        rows = truth == j
+        wrong = pred[rows][pred[rows] != j]
+        speakers[store.names[j]] = {
+            "files": int(rows.sum()),
+            "correct": int((pred[rows] == j).sum()),
+            "accuracy": float((pred[rows] == j).mean()),
+            "mean_genuine_score": float(genuine[rows].mean()),
+            "most_confused_with": store.names[np.bincount(wrong).argmax()] if len(wrong) else None,
+        }
+    return {
+        "files": n,
+        "skipped": len(truth_of) - n,
+        "speakers": len(speakers),
+        "accuracy": float((pred == truth).mean()) if n else None,
+        "eer": eer,
+        "eer_threshold": threshold,
+        "embed_seconds": embed_s,
+        "files_per_sec": n / embed_s if embed_s else None,
+        "per_speaker": speakers,
+        "confusion": {"labels": [store.names[j] for j in labels], "matrix": confusion.tolist()},
+        "vad": report.summary() if vad is not None else None,
+    }
+
+
+# batched counterpart of run_test / run_test_on_directory (data_dir given); results go to
+# `output` as json
+def run_batch_eval(profiles_path: str, data_dir: str = None, language: str = "english", max_duration: float = None,
+                   cache: EmbeddingCache = None, vad: EnergyVad = None, backend: str = "fp32",
+                   batch_size: int = 32, output: str = None, threads: int = 1) -> dict:
+    rec = Recognizer(profiles_path, language, backend=backend)
+    if data_dir:
+        from train_speaker_model import load_labeled_data, train_test_split
+        _, test_data = train_test_split(load_labeled_data(data_dir), test_ratio=0.2)
+    else:
+        test_data = rec.profiles.meta.get('test_data', {})
+    if not any(test_data.values()):
+        print("No test data in profiles. Run with --data_dir to evaluate on new data.")
+        return None
+
+    print(f"Evaluating {sum(len(v) for v in test_data.values())} test files in batches of {batch_size}...")
+    results = evaluate(rec, test_data, max_duration, cache=cache, vad=vad, batch_size=batch_size, threads=threads)
+    print("\n--- Results ---")
+    if results["files"]:
+        print(f"Accuracy: {results['accuracy']:.2%} on {results['files']} files ({results['skipped']} skipped)")
+    if results["eer"] is not None:
+        print(f"EER: {results['eer']:.2%} at threshold {results['eer_threshold']:.4f}")
+    print(f"Embedded {results['files_per_sec'] or 0:.1f} files/sec")
+    if results["vad"]:
+        print(results["vad"])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {output}")
+    return results
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Test speaker recognition model")
     parser.add_argument("--profiles", default="speaker_profiles.pkl", help="Path to speaker_profiles.pkl")
     parser.add_argument("--data_dir", default=None, help="Optional: test on data/speakers (uses train/test split)")
     parser.add_argument("--language", default="english", choices=["english", "chinese"])
     parser.add_argument("--max_duration", type=float, default=30, help="Use first N sec of each file (default 30, 0=full)")
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR, help="Embedding cache directory")
+    parser.add_argument("--cache_max_mb", type=float, default=DEFAULT_MAX_MB, help="Embedding cache size cap in MB")
+    parser.add_argument("--no_cache", action="store_true", help="Don't read or write the embedding cache")
+    parser.add_argument("--vad", action="store_true", help="Drop silence/music and use the first max_duration sec of speech")
+    parser.add_argument("--vad_threshold_db", type=float, default=-35.0, help="VAD level relative to the loudest frame")
+    parser.add_argument("--backend", default="fp32", choices=BACKENDS, help="Embedding model variant (jit/int8 are faster on CPU)")
+    parser.add_argument("--batch", action="store_true", help="Batched evaluation with EER, confusion matrix and per-speaker stats")
+    parser.add_argument("--batch_size", type=int, default=32, help="Clips per forward pass")
+    parser.add_argument("--threads", type=int, default=1, help="Threads for decoding/features and the forward passes")
+    parser.add_argument("--output", default=None, help="Write the --batch results as json")
     args = parser.parse_args()
 
     md = None if args.max_duration == 0 else args.max_duration
-    if args.data_dir:
-        run_test_on_directory(args.profiles, args.data_dir, args.language, max_duration=md)
+    cache = None if args.no_cache else EmbeddingCache(args.cache_dir, args.cache_max_mb)
+    vad = EnergyVad(threshold_db=args.vad_threshold_db) if args.vad else None
+    if args.batch:
+        run_batch_eval(args.profiles, args.data_dir, args.language, max_duration=md, cache=cache, vad=vad,
+                       backend=args.backend, batch_size=args.batch_size, output=args.output, threads=args.threads)
+    elif args.data_dir:
+        run_test_on_directory(args.profiles, args.data_dir, args.language, max_duration=md, cache=cache, vad=vad,
+                              backend=args.backend, batch_size=args.batch_size, threads=args.threads)
     else:
-        run_test(args.profiles, args.language, max_duration=md)
+        run_test(args.profiles, args.language, max_duration=md, cache=cache, vad=vad, backend=args.backend,
+                 batch_size=args.batch_size, threads=args.threads)
@@ -1,31 +1,26 @@
 #python script to train model based on speaker training audios
 import gc
+import multiprocessing as mp
 import os
-import tempfile
-import pickle
 import argparse
 from pathlib import Path
 
-import soundfile as sf
 import torch
-import torchaudio
-import wespeaker
-import numpy as np
+
+from ann_index import IVFIndex, noisy_queries, verify
+from backends import BACKENDS
+from embedding_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_MB, EmbeddingCache
+from profile_store import ProfileStore, locked
+from recognize_speaker import embed_file, embed_files
+from shards import is_packed, open_shards
+from vad import EnergyVad, SpeechReport
 
 torch.set_num_threads(1)
-def patch_torchaudio_for_soundfile():
-    def custom_load(filepath, **kwargs):
-        data, sample_rate = sf.read(filepath)
-        tensor = torch.tensor(data).float()
-        if tensor.ndim == 1:
-            tensor = tensor.unsqueeze(0)
-        else:
-            tensor = tensor.t()
-        return tensor, sample_rate
-    torchaudio.load = custom_load
 
-# loads the training data
+# loads the training data (a directory packed by shards.py gives clip refs instead of paths)
 def load_labeled_data(data_dir: str):
+    if is_packed(data_dir):
+        return open_shards(data_dir).labeled_data()
     data_path = Path(data_dir)
     if not data_path.exists():
         raise FileNotFoundError(f"Data directory not found: {data_dir}")
@@ -69,56 +64,125 @@ def train_test_split(speakers: dict, test_ratio: float = 0.2, min_train: int = 1
 
     return train_data, test_data
 
-# loads shortened audio 
-def _load_trimmed_audio(path: str, max_duration_sec: float):
-    with sf.SoundFile(path) as f:
-        sr = f.samplerate
-        n_total = len(f)
-        n_needed = int(max_duration_sec * sr) if max_duration_sec else n_total
-        n_read = min(n_needed, n_total)
-        data = f.read(n_read)
-    return data, sr
-
-# extract data from the audioos
-def extract_and_average_embeddings(model, file_paths: list, max_duration: float = None) -> np.ndarray:
+# embedding for one file, or None if it couldn't be processed
+def extract_file_embedding(model, path: str, max_duration: float = None,
+                           cache: EmbeddingCache = None, language: str = "english",
+                           vad: EnergyVad = None, report: SpeechReport = None, backend: str = "fp32"):
+    try:
+        emb = embed_file(path, language, max_duration, cache=cache, model=model, vad=vad, report=report,
+                         backend=backend)
+        if emb is not None and len(emb) > 0:
+            return emb
+    except Exception as e:
+        print(f"  Warning: Could not process {path}: {e}")
+    return None
+
+
+def _accumulate(running_sum, count, emb):
+    if emb is None:
+        return running_sum, count
+    if running_sum is None:
+        return emb.copy(), count + 1
+    running_sum += emb
+    return running_sum, count + 1
+
+# sum of the file embeddings and how many files made it in
+def extract_embedding_sum(model, file_paths: list, max_duration: float = None,
+                          cache: EmbeddingCache = None, language: str = "english",
+                          vad: EnergyVad = None, report: SpeechReport = None, backend: str = "fp32") -> tuple:
     running_sum = None
     count = 0
     for path in file_paths:
-        try:
-            if max_duration is not None:
-                data, sr = _load_trimmed_audio(path, max_duration)
-                fd, tmp_path = tempfile.mkstemp(suffix=".wav")
-                try:
-                    os.close(fd)
-                    sf.write(tmp_path, data, sr)
-                    del data 
-                    emb = model.extract_embedding(tmp_path)
-                finally:
-                    os.unlink(tmp_path)
-            else:
-                emb = model.extract_embedding(path)
-            if emb is not None and len(emb) > 0:
-                emb = np.asarray(emb).flatten()
-                if running_sum is None:
-                    running_sum = emb.copy()
-                else:
-                    running_sum += emb
-                count += 1
-        except Exception as e:
-            print(f"  Warning: Could not process {path}: {e}")
+        emb = extract_file_embedding(model, path, max_duration, cache=cache, language=language,
+                                     vad=vad, report=report, backend=backend)
+        running_sum, count = _accumulate(running_sum, count, emb)
         gc.collect()
+    return running_sum, count
+
+# each worker process keeps one model (loaded on its first cache miss) and its own cache handle
+_worker_language = "english"
+_worker_cache = None
+_worker_vad = None
+_worker_backend = "fp32"
+
+def _init_worker(language: str, cache_dir: str, cache_max_mb: float, vad: EnergyVad, backend: str = "fp32"):
+    global _worker_language, _worker_cache, _worker_vad, _worker_backend
+    torch.set_num_threads(1)
+    _worker_language = language
+    _worker_cache = EmbeddingCache(cache_dir, cache_max_mb) if cache_dir else None
+    _worker_vad = vad
+    _worker_backend = backend
+
 
-    if count == 0:
-        return None
-    return running_sum / count
+def _worker_embed(task):
+    path, max_duration = task
+    report = SpeechReport()
+    emb = extract_file_embedding(None, path, max_duration, cache=_worker_cache, language=_worker_language,
+                                 vad=_worker_vad, report=report, backend=_worker_backend)
+    return emb, report
+
+# embeds every file across `workers` processes; sums are reduced here in the original
+# file order so the results are bit-identical to extract_embedding_sum() (--batch_size 1).
+# The default batched path only agrees with either to about 1e-7
+def extract_sums_parallel(train_data: dict, language: str, max_duration: float = None, workers: int = 2,
+                          cache: EmbeddingCache = None, vad: EnergyVad = None, report: SpeechReport = None,
+                          backend: str = "fp32") -> dict:
+    tasks = [(path, max_duration) for paths in train_data.values() for path in paths]
+    cache_args = (cache.cache_dir, cache.max_bytes / (1024 * 1024)) if cache is not None else (None, 0)
+    sums = {}
+    with mp.Pool(workers, initializer=_init_worker, initargs=(language, *cache_args, vad, backend)) as pool:
+        results = pool.imap(_worker_embed, tasks)
+        for name, paths in train_data.items():
+            running_sum, count = None, 0
+            for _ in paths:
+                emb, file_report = next(results)
+                if report is not None:
+                    report.merge(file_report)
+                running_sum, count = _accumulate(running_sum, count, emb)
+            sums[name] = (running_sum, count)
+    return sums
+
+
+# embedding sums for every speaker: across worker processes, in length-bucketed batches
+# (batch_size > 1, see embed_files) or one file at a time. Sums are taken in file order
+def extract_speaker_sums(train_data: dict, language: str = "english", max_duration: float = None,
+                         workers: int = 1, cache: EmbeddingCache = None, vad: EnergyVad = None,
+                         report: SpeechReport = None, backend: str = "fp32", batch_size: int = 1,
+                         threads: int = 1) -> dict:
+    if workers > 1:
+        print(f"Embedding with {workers} worker processes...")
+        sums = extract_sums_parallel(train_data, language, max_duration=max_duration, workers=workers, cache=cache,
+                                     vad=vad, report=report, backend=backend)
+    elif batch_size > 1:
+        print(f"Embedding in batches of {batch_size}...")
+        embs = embed_files([p for paths in train_data.values() for p in paths], language, max_duration, cache=cache,
+                           vad=vad, report=report, backend=backend, batch_size=batch_size, threads=threads)
+        sums = {}
+        for name, paths in train_data.items():
+            running_sum, count = None, 0
+            for path in paths:
+                running_sum, count = _accumulate(running_sum, count, embs.get(path))
+            sums[name] = (running_sum, count)
+    else:
+        sums = None
+    results = {}
+    for name, paths in train_data.items():
+        print(f"  {name}: {len(paths)} training samples")
+        if sums is not None:
+            results[name] = sums[name]
+        else:
+            results[name] = extract_embedding_sum(None, paths, max_duration=max_duration, cache=cache,
+                                                  language=language, vad=vad, report=report, backend=backend)
+        if results[name][1] == 0:
+            print(f"  Warning: No valid embeddings for {name}, skipping")
+        gc.collect()
+    return {name: r for name, r in results.items() if r[1] > 0}
 
 # trains the ai model
 def train(data_dir: str = "data/speakers", output_path: str = "speaker_profiles.pkl",
-          test_ratio: float = 0.2, language: str = "english", max_duration: float = None):
-    print("Loading wespeaker model...")
-    patch_torchaudio_for_soundfile()
-    model = wespeaker.load_model(language)
-
+          test_ratio: float = 0.2, language: str = "english", max_duration: float = None,
+          workers: int = 1, cache: EmbeddingCache = None, vad: EnergyVad = None, ann_lists: int = None,
+          backend: str = "fp32", batch_size: int = 32, threads: int = 1):
     print(f"Loading labeled data from {data_dir}...")
     speakers = load_labeled_data(data_dir)
     if not speakers:
@@ -128,36 +192,98 @@ def train(data_dir: str = "data/speakers", output_path: str = "speaker_profiles.
     train_data, test_data = train_test_split(speakers, test_ratio=test_ratio)
 
     if max_duration:
-        print(f"Using first {max_duration}s of each file (faster for long recordings)")
+        print(f"Using first {max_duration}s of {'speech in ' if vad else ''}each file (faster for long recordings)")
     print("\nBuilding voice profiles...")
-    profiles = {}
-    for name, paths in train_data.items():
-        print(f"  {name}: {len(paths)} training samples")
-        emb = extract_and_average_embeddings(model, paths, max_duration=max_duration)
-        if emb is not None:
-            profiles[name] = emb
-        else:
-            print(f"  Warning: No valid embeddings for {name}, skipping")
-        gc.collect()
-
-    if not profiles:
+    report = SpeechReport()
+    sums = extract_speaker_sums(train_data, language, max_duration=max_duration, workers=workers, cache=cache,
+                                vad=vad, report=report, backend=backend, batch_size=batch_size, threads=threads)
+    if vad is not None:
+        print(report.summary())
+    if not sums:
         raise ValueError("No valid speaker profiles could be built.")
+    profiles = {name: running_sum / count for name, (running_sum, count) in sums.items()}
 
     # save profiles
     output = Path(output_path)
     output.parent.mkdir(parents=True, exist_ok=True)
-    with open(output, 'wb') as f:
-        pickle.dump({
-            'profiles': profiles,
-            'speakers': list(profiles.keys()),
+    store = ProfileStore.from_sums(
+        {name: s for name, (s, _) in sums.items()},
+        {name: c for name, (_, c) in sums.items()},
+        meta={
             'train_data': {k: v for k, v in train_data.items() if k in profiles},
             'test_data': {k: v for k, v in test_data.items() if k in profiles},
-        }, f)
+            'backend': backend,
+        },
+    )
+    if ann_lists is not None:
+        build_ann_index(store, ann_lists)
+    store.save(str(output))
 
     print(f"\nSaved {len(profiles)} speaker profiles to {output_path}")
     return profiles, test_data
 
 
+# IVF index over the profiles (0 lists = sqrt(N)), checked against exact search
+def build_ann_index(store: ProfileStore, n_lists: int = 0, n_probe: int = 8):
+    store.ann = IVFIndex.build(store.matrix, store.names, n_lists=n_lists or None)
+    check = verify(store, noisy_queries(store.matrix), n_probe)
+    print(f"Built ANN index with {store.ann.n_lists} lists; top-1 agreement with exact search "
+          f"at n_probe={n_probe}: {check['top1_agreement']:.2%}")
+    return store.ann
+
+
+# wav files to enroll: a directory in the same layout as --data_dir, loose name.wav files,
+# or (with name) any mix of files/directories that all belong to one speaker
+def collect_enrollment(paths: list, name: str = None) -> dict:
+    speakers = {}
+    for p in paths:
+        if os.path.isdir(p):
+            found = load_labeled_data(p)
+            if name:
+                speakers.setdefault(name, []).extend(f for files in found.values() for f in files)
+            else:
+                for speaker, files in found.items():
+                    speakers.setdefault(speaker, []).extend(files)
+        else:
+            speakers.setdefault(name or Path(p).stem, []).append(p)
+    return speakers
+
+# adds new files to new or existing speakers; only those speakers' files get embedded
+def enroll(profiles_path: str, speakers: dict, language: str = "english", max_duration: float = None,
+           workers: int = 1, cache: EmbeddingCache = None, vad: EnergyVad = None,
+           backend: str = "fp32", batch_size: int = 32, threads: int = 1) -> ProfileStore:
+    print(f"Enrolling {sum(len(v) for v in speakers.values())} files for {len(speakers)} speakers...")
+    report = SpeechReport()
+    sums = extract_speaker_sums(speakers, language, max_duration=max_duration, workers=workers, cache=cache,
+                                vad=vad, report=report, backend=backend, batch_size=batch_size, threads=threads)
+    if vad is not None:
+        print(report.summary())
+    # loaded only now, under the lock, so changes saved while we were embedding are kept
+    with locked(profiles_path):
+        store = ProfileStore.load(profiles_path) if os.path.isfile(profiles_path) else ProfileStore([], [], [])
+        for name, (running_sum, count) in sums.items():
+            action = "Updated" if name in store.index else "Added"
+            store.add(name, running_sum, count, files=speakers[name])
+            print(f"  {action} {name} (+{count} files)")
+        store.save(profiles_path)
+    print(f"\nSaved {len(store)} speaker profiles to {profiles_path}")
+    return store
+
+# drops speakers from the profile file
+def unenroll(profiles_path: str, names: list) -> ProfileStore:
+    with locked(profiles_path):
+        store = ProfileStore.load(profiles_path)
+        for name in names:
+            if name in store.index:
+                store.remove(name)
+                print(f"  Removed {name}")
+            else:
+                print(f"  Warning: {name} is not enrolled")
+        store.save(profiles_path)
+    print(f"\nSaved {len(store)} speaker profiles to {profiles_path}")
+    return store
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Train speaker recognition from labeled data")
     parser.add_argument("--data_dir", default="data/speakers", help="Directory with data/speakers/{name}/*.wav")
@@ -165,7 +291,31 @@ if __name__ == "__main__":
     parser.add_argument("--test_ratio", type=float, default=0.2, help="Fraction of data for testing")
     parser.add_argument("--language", default="english", choices=["english", "chinese"])
     parser.add_argument("--max_duration", type=float, default=30, help="Use only first N seconds of each file (default: 30, use 0 for full)")
+    parser.add_argument("--workers", type=int, default=1, help="Embed files in N parallel processes (default 1)")
+    parser.add_argument("--batch_size", type=int, default=32, help="Clips per forward pass without --workers (1 = one at a time)")
+    parser.add_argument("--threads", type=int, default=1, help="Threads for decoding/features and the batched forward passes")
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR, help="Embedding cache directory")
+    parser.add_argument("--cache_max_mb", type=float, default=DEFAULT_MAX_MB, help="Embedding cache size cap in MB")
+    parser.add_argument("--no_cache", action="store_true", help="Don't read or write the embedding cache")
+    parser.add_argument("--add", nargs="+", metavar="PATH", help="Enroll wav files/directories into --output without retraining everyone")
+    parser.add_argument("--name", default=None, help="Speaker name for the files given to --add")
+    parser.add_argument("--remove", nargs="+", metavar="NAME", help="Remove these speakers from --output")
+    parser.add_argument("--vad", action="store_true", help="Drop silence/music and use the first max_duration sec of speech")
+    parser.add_argument("--vad_threshold_db", type=float, default=-35.0, help="VAD level relative to the loudest frame")
+    parser.add_argument("--backend", default="fp32", choices=BACKENDS, help="Embedding model variant (jit/int8 are faster on CPU)")
+    parser.add_argument("--ann_lists", type=int, default=None, help="Also build an ANN index with N lists (0 = sqrt(speakers))")
     args = parser.parse_args()
 
     md = None if args.max_duration == 0 else args.max_duration
-    train(args.data_dir, args.output, args.test_ratio, args.language, max_duration=md)
+    cache = None if args.no_cache else EmbeddingCache(args.cache_dir, args.cache_max_mb)
+    vad = EnergyVad(threshold_db=args.vad_threshold_db) if args.vad else None
+    if args.remove:
+        unenroll(args.output, args.remove)
+    if args.add:
+        enroll(args.output, collect_enrollment(args.add, args.name), args.language, max_duration=md,
+               workers=args.workers, cache=cache, vad=vad, backend=args.backend, batch_size=args.batch_size,
+               threads=args.threads)
+    if not args.add and not args.remove:
+        train(args.data_dir, args.output, args.test_ratio, args.language, max_duration=md, workers=args.workers,
+              cache=cache, vad=vad, ann_lists=args.ann_lists, backend=args.backend, batch_size=args.batch_size,
+              threads=args.threads)
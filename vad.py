@@ -0,0 +1,85 @@
+# energy-based voice activity detection, run before embedding
+import numpy as np
+import torch
+
+
+class EnergyVad:
+    """Frame-level energy VAD.
+
+    A frame counts as speech when its RMS level is within threshold_db of the loudest
+    frame in the clip and above floor_db overall. Speech frames are widened by
+    hangover_ms on each side so word onsets/offsets survive, then concatenated.
+    Music beds and room tone sit well below the speech peaks in our recordings, so
+    this drops them without running a model."""
+
+    def __init__(self, threshold_db: float = -35.0, floor_db: float = -55.0, frame_ms: float = 30.0,
+                 hangover_ms: float = 90.0):
+        self.threshold_db = threshold_db
+        self.floor_db = floor_db
+        self.frame_ms = frame_ms
+        self.hangover_ms = hangover_ms
+
+    # part of the embedding cache key
+    def settings(self) -> dict:
+        return {"threshold_db": self.threshold_db, "floor_db": self.floor_db,
+                "frame_ms": self.frame_ms, "hangover_ms": self.hangover_ms}
+
+    def speech_mask(self, mono: np.ndarray, sample_rate: int) -> np.ndarray:
+        frame = max(1, int(sample_rate * self.frame_ms / 1000))
+        n_frames = -(-len(mono) // frame)
+        padded = np.zeros(n_frames * frame, dtype=np.float32)
+        padded[:len(mono)] = mono
+        power = np.mean(padded.reshape(n_frames, frame) ** 2, axis=1)
+        level_db = 10 * np.log10(power + 1e-10)
+        threshold = max(level_db.max() + self.threshold_db, self.floor_db)
+        mask = level_db > threshold
+        hang = int(round(self.hangover_ms / self.frame_ms))
+        if hang > 0 and mask.any():
+            mask = np.convolve(mask.astype(np.int32), np.ones(2 * hang + 1, dtype=np.int32), mode='same') > 0
+        return np.repeat(mask, frame)[:len(mono)]
+
+    # returns (speech-only waveform capped at max_speech_sec, stats); if nothing looks like
+    # speech the (capped) original comes back so there's still something to embed
+    def __call__(self, waveform: torch.Tensor, sample_rate: int, max_speech_sec: float = None):
+        n_total = waveform.shape[-1]
+        mono = waveform.mean(dim=0) if waveform.shape[0] > 1 else waveform[0]
+        mask = self.speech_mask(mono.numpy(), sample_rate)
+        n_speech = int(mask.sum())
+        speech = waveform[:, torch.from_numpy(mask)] if n_speech else waveform
+        if max_speech_sec:
+            speech = speech[:, :int(max_speech_sec * sample_rate)]
+        stats = {
+            "total_sec": n_total / sample_rate,
+            "speech_sec": n_speech / sample_rate,
+            "skipped_sec": (n_total - n_speech) / sample_rate,
+            "used_sec": speech.shape[-1] / sample_rate,
+        }
+        return speech, stats
+
+
+class SpeechReport:
+    """Running totals of what the VAD kept and skipped, for printing after a run."""
+
+    def __init__(self):
+        self.files = 0
+        self.total_sec = 0.0
+        self.skipped_sec = 0.0
+        self.used_sec = 0.0
+
+    def add(self, stats: dict):
+        if not stats:
+            return
+        self.files += 1
+        self.total_sec += stats["total_sec"]
+        self.skipped_sec += stats["skipped_sec"]
+        self.used_sec += stats["used_sec"]
+
+    def merge(self, other: "SpeechReport"):
+        self.files += other.files
+        self.total_sec += other.total_sec
+        self.skipped_sec += other.skipped_sec
+        self.used_sec += other.used_sec
+
+    def summary(self) -> str:
+        return (f"VAD: {self.files} files, skipped {self.skipped_sec:.1f}s of non-speech out of "
+                f"{self.total_sec:.1f}s scanned, embedded {self.used_sec:.1f}s of speech")